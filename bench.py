@@ -0,0 +1,413 @@
+import argparse, json, math, os, random, sys, tempfile, time, types
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from trace import BatchTracer, ImageTracer, MaskEngine, rasterize_svg
+
+def synthetic_image(width=1024, height=1024, blobs=400, seed=1):
+    ''' Generate a blurred image of random coloured ellipses '''
+    rnd = random.Random(seed)
+    img = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for _ in range(blobs):
+        x, y = rnd.randint(0, width), rnd.randint(0, height)
+        r = rnd.randint(width // 100 + 1, width // 8 + 2)
+        color = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    return img.filter(ImageFilter.GaussianBlur(2))
+
+def legacy_masks(q, min_pixels):
+    ''' Per-colour list based masks, as process_image used to build them '''
+    w, h = q.size
+    indices = list(q.tobytes())
+    for idx in sorted(set(indices)):
+        if indices.count(idx) < min_pixels:
+            continue
+        mask = Image.new('L', (w, h), 255)
+        mask.putdata([0 if p == idx else 255 for p in indices])
+
+def engine_masks(q, min_pixels):
+    ''' Masks from the single pass MaskEngine '''
+    masks = MaskEngine(q)
+    for idx, mask in masks.iter_masks(masks.used_indices(min_pixels)):
+        pass
+
+def bench_masks(size=1024, legacy=False):
+    ''' Time the mask stage for every n_colors level in quality_presets '''
+    tracer = ImageTracer()
+    img = synthetic_image(size, size)
+    print(f'mask stage, {size}x{size} pixels')
+    print(f"{'n_colors':>8} {'engine':>10} {'legacy':>10}")
+    for level in sorted(tracer.quality_presets):
+        n_colors, min_pixels = tracer.quality_presets[level][:2]
+        q = img.convert('P', palette=Image.ADAPTIVE, colors=n_colors)
+
+        start = time.perf_counter()
+        engine_masks(q, min_pixels)
+        engine_time = time.perf_counter() - start
+
+        legacy_text = '-'
+        if legacy:
+            start = time.perf_counter()
+            legacy_masks(q, min_pixels)
+            legacy_text = f'{time.perf_counter() - start:.3f}s'
+
+        print(f'{n_colors:>8} {engine_time:>9.3f}s {legacy_text:>10}')
+
+def bench_parallel(size=1024, workers=None):
+    ''' Compare serial and process pool tracing for every quality preset '''
+    workers = workers or os.cpu_count()
+    tracer = ImageTracer()
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.png')
+        synthetic_image(size, size).save(source)
+        print(f'per-colour tracing, {size}x{size} pixels, {workers} workers')
+        print(f"{'quality':>7} {'serial':>10} {'parallel':>10} {'speedup':>8} {'identical':>9}")
+        for level in sorted(tracer.quality_presets):
+            serial_out = os.path.join(tmp, 'serial.svg')
+            parallel_out = os.path.join(tmp, 'parallel.svg')
+
+            start = time.perf_counter()
+            tracer.process_image(source, serial_out, quality=level)
+            serial_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            tracer.process_image(source, parallel_out, quality=level, workers=workers)
+            parallel_time = time.perf_counter() - start
+
+            with open(serial_out, 'rb') as a, open(parallel_out, 'rb') as b:
+                identical = a.read() == b.read()
+            speedup = serial_time / parallel_time
+            print(f'{level:>7} {serial_time:>9.2f}s {parallel_time:>9.2f}s {speedup:>7.2f}x {str(identical):>9}')
+
+def bench_serialize(size=1024):
+    ''' Compare the default and compact path serializers for every quality preset '''
+    tracer = ImageTracer()
+    img = synthetic_image(size, size)
+    print(f'path serialization, {size}x{size} pixels')
+    print(f"{'quality':>7} {'default':>10} {'compact':>10} {'speedup':>8} {'bytes':>10} {'compact':>10} {'ratio':>6}")
+    for level in sorted(tracer.quality_presets):
+        tracer.configure_quality(level)
+        q = tracer.quantize(img)
+        masks = MaskEngine(q)
+        jobs = tracer.color_jobs(q, masks)
+        traced = [(tracer.trace_image(mask), fill) for (_, fill), (_, mask) in zip(jobs, masks.iter_masks([idx for idx, fill in jobs]))]
+
+        results = []
+        for compact in (False, True):
+            tracer.compact = compact
+            start = time.perf_counter()
+            size_bytes = sum(len(path) for plist, fill in traced for path in tracer.iter_svg(plist, fill))
+            results.append((time.perf_counter() - start, size_bytes))
+        tracer.compact = False
+
+        (default_time, default_bytes), (compact_time, compact_bytes) = results
+        print(f'{level:>7} {default_time:>9.3f}s {compact_time:>9.3f}s {default_time / compact_time:>7.2f}x '
+              f'{default_bytes:>10} {compact_bytes:>10} {compact_bytes / default_bytes:>6.2f}')
+
+def bench_quantize(size=1024):
+    ''' Time every quantizer, and reuse of a fixed palette, at each n_colors level '''
+    tracer = ImageTracer()
+    img = synthetic_image(size, size)
+    source = np.asarray(img, dtype=np.int16)
+    methods = list(tracer.quantizers) + ['fixed']
+    print(f'quantization, {size}x{size} pixels, time and mean absolute error')
+    print(f"{'n_colors':>8} " + ' '.join(f'{m:>16}' for m in methods))
+    for level in sorted(tracer.quality_presets):
+        tracer.configure_quality(level)
+        cells = []
+        for method in methods:
+            tracer.quantizer = 'mediancut' if method == 'fixed' else method
+            # a fixed palette is built once per batch, so only the mapping is timed
+            tracer.palette = tracer.load_palette_from(img) if method == 'fixed' else None
+            start = time.perf_counter()
+            q = tracer.quantize(img)
+            elapsed = time.perf_counter() - start
+            error = np.abs(np.asarray(q.convert('RGB'), dtype=np.int16) - source).mean()
+            cells.append(f'{elapsed:>7.3f}s {error:>6.2f}')
+        tracer.palette = None
+        print(f'{tracer.n_colors:>8} ' + ' '.join(f'{c:>16}' for c in cells))
+
+def measure_preset(tracer, source, level, output_filename):
+    ''' Trace one image at a quality level and collect its stage profile and fidelity figures '''
+    profile = tracer.process_image(source, output_filename, quality=level).to_dict()
+
+    original = Image.open(source).convert('RGB')
+    w, h = profile['size']
+    raster = rasterize_svg(output_filename, original.size, original.width / w)
+    error = np.abs(np.asarray(raster, dtype=np.int16) - np.asarray(original, dtype=np.int16)).mean()
+
+    return {
+        'quality': level,
+        'stages': {name: stage['wall'] for name, stage in profile['stages'].items()},
+        'time': profile['wall'],
+        'paths': profile['paths'],
+        'segments': profile['segments'],
+        'bytes': os.path.getsize(output_filename),
+        'error': float(error),
+    }
+
+def print_measurements(name, results):
+    ''' Print one table row per quality preset '''
+    stage_names = list(results[0]['stages'])
+    print(name)
+    print(f"{'quality':>7} " + ' '.join(f'{s:>9}' for s in stage_names) + f" {'total':>8} {'paths':>7} {'segments':>9} {'bytes':>9} {'error':>6}")
+    for r in results:
+        stage_text = ' '.join(f"{r['stages'][s]:>8.3f}s" for s in stage_names)
+        print(f"{r['quality']:>7} {stage_text} {r['time']:>7.3f}s {r['paths']:>7} {r['segments']:>9} {r['bytes']:>9} {r['error']:>6.2f}")
+
+def bench_presets(corpus=None, size=512):
+    ''' Run every quality preset over a corpus of images, synthetic ones if none is given '''
+    tracer = ImageTracer()
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = [path for path, output in BatchTracer(tmp).expand_inputs(corpus or [])]
+        if not sources:
+            for seed in range(3):
+                path = os.path.join(tmp, f'synthetic{seed}.png')
+                synthetic_image(size, size, seed=seed).save(path)
+                sources.append(path)
+
+        output = os.path.join(tmp, 'output.svg')
+        for source in sources:
+            results = [measure_preset(tracer, source, level, output) for level in sorted(tracer.quality_presets)]
+            print_measurements(os.path.basename(source), results)
+
+def autotune(source, max_error=None, max_bytes=None):
+    ''' Return the fastest quality level whose output meets the error and size budgets, or None '''
+    tracer = ImageTracer()
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'output.svg')
+        results = [measure_preset(tracer, source, level, output) for level in sorted(tracer.quality_presets)]
+    print_measurements(os.path.basename(source), results)
+
+    candidates = [
+        r for r in results
+        if (max_error is None or r['error'] <= max_error) and (max_bytes is None or r['bytes'] <= max_bytes)
+    ]
+    if not candidates:
+        print('no preset meets the budget')
+        return None
+
+    best = min(candidates, key=lambda r: r['time'])
+    print(f"fastest preset within budget: quality {best['quality']} ({best['time']:.3f}s, error {best['error']:.2f}, {best['bytes']} bytes)")
+    return best['quality']
+
+def synthetic_document(vertices=None, shapes=None, extent=10000, seed=1):
+    ''' Build a ShapeStore of random triangles, rectangles and circles, stopping at a vertex or shape count '''
+    from draw import ShapeStore
+    rnd = np.random.default_rng(seed)
+    store = ShapeStore()
+    while (vertices is None or store.vertex_count < vertices) and (shapes is None or len(store) < shapes):
+        shape_type = ('triangle', 'rectangle', 'circle')[int(rnd.integers(0, 3))]
+        size = rnd.uniform(4, 60)
+        corner = rnd.random(2) * extent
+        points = corner + rnd.random((4 if shape_type == 'rectangle' else 3, 2)) * size
+        fill = tuple(rnd.integers(0, 256, 3).tolist()) if rnd.random() < 0.5 else None
+        store.append(shape_type, points, (0, 0, 0), int(rnd.integers(1, 8)), fill, True)
+    return store
+
+def percentiles(samples):
+    ''' p50/p95/p99 of a list of durations in seconds, in milliseconds '''
+    return [float(v) * 1000 for v in np.percentile(samples, (50, 95, 99))]
+
+def time_frames(action, frames):
+    ''' Run an action repeatedly and return its per-call durations '''
+    samples = []
+    for i in range(frames):
+        start = time.perf_counter()
+        action(i)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def bench_render(counts=(1000, 10000, 100000), frames=100, output=None, baseline=None):
+    ''' Time shape, grid, pan/zoom and export rendering headlessly on generated documents '''
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    import pygame
+    from draw import DrawApp
+
+    app = DrawApp(headless=True)
+    app.show_grid = True
+    previous = {}
+    if baseline:
+        with open(baseline) as file:
+            previous = {(r['shapes'], r['stage']): r for r in json.load(file)}
+
+    results = []
+    print(f'headless rendering, {app.window_size[0]}x{app.window_size[1]}, times in ms')
+    print(f"{'shapes':>7} {'stage':>12} {'p50':>8} {'p95':>8} {'p99':>8} {'vs base':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            # constant density, about 75 shapes are on screen at the default view whatever the document size
+            extent = 800 * math.sqrt(count / 100)
+            app.shapes = synthetic_document(shapes=count, extent=extent)
+            app.rebuild_index()
+            app.history.max_bytes = 0
+            app.set_view((1, 0.0, 0.0))
+            export_path = os.path.join(tmp, 'export.py')
+
+            def pan(i):
+                app.router.dispatch([pygame.event.Event(pygame.MOUSEMOTION, pos=(0, 0), rel=(7, 5), buttons=(1, 0, 0))])
+                app.draw_frame()
+
+            def zoom(i):
+                app.router.dispatch([pygame.event.Event(pygame.MOUSEWHEEL, x=0, y=1 if i % 2 == 0 else -1)])
+                app.draw_frame()
+
+            stages = [
+                ('draw_shapes', lambda i: app.draw_shapes(app.scene_layer, app.visible_shapes()), frames),
+                ('grid', lambda i: app.draw_grid_lines(app.scene_layer), frames),
+                ('idle frame', lambda i: app.draw_frame(), frames),
+                ('pan', pan, frames),
+                ('zoom', zoom, frames),
+                ('export', lambda i: app.write_tk_script(export_path), max(3, frames // 20)),
+            ]
+            for stage, action, n in stages:
+                p50, p95, p99 = percentiles(time_frames(action, n))
+                base = previous.get((count, stage))
+                ratio = f"{p50 / base['p50']:>7.2f}x" if base else '-'
+                print(f'{count:>7} {stage:>12} {p50:>8.3f} {p95:>8.3f} {p99:>8.3f} {ratio:>8}')
+                results.append({'shapes': count, 'stage': stage, 'p50': p50, 'p95': p95, 'p99': p99})
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=1)
+    pygame.quit()
+    return results
+
+def bench_document(vertices=1000000, edits=10000):
+    ''' Time saving, mapping and journalling a large drawing document '''
+    from draw import DocumentJournal, ShapeStore
+    store = synthetic_document(vertices)
+    print(f'document, {len(store)} shapes, {store.vertex_count} vertices')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'drawing.tkd')
+
+        start = time.perf_counter()
+        end = store.save(path)
+        print(f'{"save":>22} {time.perf_counter() - start:>8.3f}s {os.path.getsize(path):>11} bytes')
+
+        start = time.perf_counter()
+        loaded, _ = ShapeStore.load(path)
+        print(f'{"load (mapped)":>22} {time.perf_counter() - start:>8.3f}s')
+
+        start = time.perf_counter()
+        loaded, _ = ShapeStore.load(path)
+        loaded.bounds()
+        print(f'{"load + bounds":>22} {time.perf_counter() - start:>8.3f}s')
+
+        identical = all(np.array_equal(getattr(store, name)[:len(getattr(loaded, name))], getattr(loaded, name)) for name, _, _ in ShapeStore.fields)
+        print(f'{"identical":>22} {identical}')
+
+        journal = DocumentJournal(path, end)
+        start = time.perf_counter()
+        for shape_id in range(edits):
+            journal.write_add(store, shape_id)
+        elapsed = time.perf_counter() - start
+        journal.close()
+        print(f'{"journal append":>22} {elapsed / edits * 1e6:>8.1f}us per shape ({edits} shapes)')
+
+        start = time.perf_counter()
+        loaded, _ = ShapeStore.load(path)
+        print(f'{"load + replay":>22} {time.perf_counter() - start:>8.3f}s ({len(loaded)} shapes)')
+
+class StubCanvas:
+    ''' Stands in for tk.Canvas so script startup can be timed without a display, items are only counted '''
+    items = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def pack(self):
+        pass
+
+    def create_item(self, *args, **kwargs):
+        StubCanvas.items += 1
+
+    create_polygon = create_rectangle = create_oval = create_item
+
+class StubTk:
+    def __init__(self):
+        self.pending = []
+
+    def title(self, text):
+        pass
+
+    def after(self, ms, callback, *args):
+        self.pending.append((callback, args))
+
+    def mainloop(self):
+        while self.pending:
+            callback, args = self.pending.pop(0)
+            callback(*args)
+
+def run_tk_script(filename):
+    ''' Compile and run an exported script against the stub tkinter, returns the number of items created '''
+    stub = types.ModuleType('tkinter')
+    stub.Tk, stub.Canvas = StubTk, StubCanvas
+    real = sys.modules.get('tkinter')
+    sys.modules['tkinter'] = stub
+    StubCanvas.items = 0
+    try:
+        with open(filename, encoding='utf-8') as file:
+            exec(compile(file.read(), filename, 'exec'), {'__name__': '__main__'})
+    finally:
+        if real is not None:
+            sys.modules['tkinter'] = real
+    return StubCanvas.items
+
+def bench_export(counts=(1000, 10000, 100000)):
+    ''' Compare the per-line and packed tkinter exporters, export time, script size and script startup time '''
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    from draw import DrawApp
+
+    app = DrawApp(headless=True)
+    print('tkinter export, startup is compile + run with a stub tkinter (Tk item cost excluded)')
+    print(f"{'shapes':>7} {'mode':>7} {'export':>9} {'bytes':>11} {'startup':>9} {'items':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            app.shapes = synthetic_document(shapes=count, extent=800 * math.sqrt(count / 100))
+            for mode in ('lines', 'packed'):
+                path = os.path.join(tmp, f'{mode}.py')
+                start = time.perf_counter()
+                app.write_tk_script(path, mode)
+                export_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                items = run_tk_script(path)
+                startup_time = time.perf_counter() - start
+                print(f'{count:>7} {mode:>7} {export_time:>8.3f}s {os.path.getsize(path):>11} {startup_time:>8.3f}s {items:>7}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tracing and drawing benchmarks')
+    parser.add_argument('benchmark', choices=['masks', 'parallel', 'serialize', 'quantize', 'presets', 'autotune', 'document', 'render', 'export'])
+    parser.add_argument('images', nargs='*', help='corpus files, directories or globs for presets and autotune')
+    parser.add_argument('--size', type=int, default=1024, help='synthetic image width and height')
+    parser.add_argument('--legacy', action='store_true', help='also time the old implementation')
+    parser.add_argument('--workers', type=int, default=None, help='process pool size, defaults to cpu count')
+    parser.add_argument('--max-error', type=float, default=None, help='autotune mean absolute error budget (0-255)')
+    parser.add_argument('--max-bytes', type=int, default=None, help='autotune SVG size budget')
+    parser.add_argument('--vertices', type=int, default=1000000, help='synthetic drawing size for the document benchmark')
+    parser.add_argument('--shapes', type=int, nargs='+', default=[1000, 10000, 100000], help='document sizes for the render and export benchmarks')
+    parser.add_argument('--frames', type=int, default=100, help='frames timed per render stage')
+    parser.add_argument('--json', default=None, help='write render results to this file')
+    parser.add_argument('--baseline', default=None, help='compare render results against an earlier --json file')
+    args = parser.parse_args()
+
+    if args.benchmark == 'masks':
+        bench_masks(args.size, args.legacy)
+    elif args.benchmark == 'parallel':
+        bench_parallel(args.size, args.workers)
+    elif args.benchmark == 'serialize':
+        bench_serialize(args.size)
+    elif args.benchmark == 'quantize':
+        bench_quantize(args.size)
+    elif args.benchmark == 'presets':
+        bench_presets(args.images, args.size)
+    elif args.benchmark == 'autotune':
+        for image in args.images:
+            autotune(image, args.max_error, args.max_bytes)
+    elif args.benchmark == 'document':
+        bench_document(args.vertices)
+    elif args.benchmark == 'export':
+        bench_export(args.shapes)
+    elif args.benchmark == 'render':
+        bench_render(args.shapes, args.frames, args.json, args.baseline)
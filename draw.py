@@ -1,17 +1,704 @@
-import pygame, sys, time, math
-import tkinter as tk
+import pygame, sys, time, math, os, struct, argparse, csv, json, base64, queue, subprocess, threading
+import numpy as np
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+def hsv_to_rgb(hue, sat, val):
+    ''' Vectorised pygame.Color.hsva conversion, hue in degrees and sat/val in percent, returns uint8 RGB '''
+    hue, sat, val = np.broadcast_arrays(np.asarray(hue, dtype=np.float64), np.asarray(sat, dtype=np.float64) / 100, np.asarray(val, dtype=np.float64) / 100)
+    sector = np.floor(hue / 60).astype(int)
+    f = hue / 60 - sector
+    p = val * (1 - sat)
+    q = val * (1 - sat * f)
+    t = val * (1 - sat * (1 - f))
+    sector %= 6
+    r = np.choose(sector, [val, q, p, p, t, val])
+    g = np.choose(sector, [t, val, val, q, p, p])
+    b = np.choose(sector, [p, p, t, val, val, q])
+    return (np.stack((r, g, b), axis=-1) * 255).astype(np.uint8)
+
+def cubic_controls(start, segments, offset=(0.0, 0.0)):
+    ''' Turn a parsed SVG subpath into closed cubic control points p0, c1, c2, p1, c1, c2, p2 ..., lines become straight cubics '''
+    controls = [start]
+    x0, y0 = start
+    if segments and segments[-1][-1] != start:
+        segments = segments + [('L', start)]
+    for segment in segments:
+        if segment[0] == 'L':
+            x1, y1 = segment[1]
+            controls += [(x0 + (x1 - x0) / 3, y0 + (y1 - y0) / 3), (x0 + 2 * (x1 - x0) / 3, y0 + 2 * (y1 - y0) / 3), (x1, y1)]
+        else:
+            controls += segment[1:]
+        x0, y0 = controls[-1]
+    return np.array(controls, dtype=np.float64) + offset
+
+def flatten_cubics(controls, tolerance):
+    ''' Flatten cubic control points into polygon vertices, splitting each curve so it deviates at most tolerance '''
+    p0, c1, c2, p1 = controls[:-1:3], controls[1::3], controls[2::3], controls[3::3]
+    # Wang's formula, as in trace.flatten_path; straight cubics have no second difference and stay one line
+    dd = np.maximum(np.abs(p0 - 2 * c1 + c2), np.abs(c1 - 2 * c2 + p1))
+    n = np.maximum(1, np.ceil(np.sqrt(0.75 * np.hypot(dd[:, 0], dd[:, 1]) / tolerance))).astype(np.int64)
+    segment = np.repeat(np.arange(len(n)), n)
+    t = (np.arange(int(n.sum())) - np.repeat(np.cumsum(n) - n, n) + 1) / n[segment]
+    t = t[:, None]
+    mt = 1 - t
+    points = mt * mt * mt * p0[segment] + 3 * mt * mt * t * c1[segment] + 3 * mt * t * t * c2[segment] + t * t * t * p1[segment]
+    return np.vstack((controls[:1], points))
+
+class ShapeView:
+    ''' Lightweight view of one shape in a ShapeStore, unpacks like the old shape lists '''
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def type(self):
+        return self.store.type_names[self.store.types[self.index]]
+
+    @property
+    def points(self):
+        ''' The shape's vertices as an (n, 2) view into the store's vertex buffer '''
+        offsets = self.store.offsets
+        return self.store.vertices[offsets[self.index]:offsets[self.index + 1]]
+
+    @property
+    def border_color(self):
+        return tuple(self.store.border_colors[self.index].tolist())
+
+    @property
+    def line_width(self):
+        return int(self.store.line_widths[self.index])
+
+    @property
+    def fill_color(self):
+        if not self.store.has_fill[self.index]:
+            return None
+        return tuple(self.store.fill_colors[self.index].tolist())
+
+    @property
+    def show_border(self):
+        return bool(self.store.show_borders[self.index])
+
+    def __iter__(self):
+        return iter((self.type, self.points, self.border_color, self.line_width, self.fill_color, self.show_border))
+
+class ShapeStore:
+    ''' Struct-of-arrays shape storage, all vertices live in one float buffer indexed by per-shape offsets '''
+    type_names = ('triangle', 'rectangle', 'circle', 'path')
+
+    # document file: header, then each array 8-byte aligned so it can be mapped in place, then the journal
+    magic = b'TKDRAW01'
+    header = struct.Struct('<8sQQQ')
+    fields = (
+        ('offsets', np.int64, ()),
+        ('vertices', np.float64, (2,)),
+        ('types', np.uint8, ()),
+        ('border_colors', np.uint8, (3,)),
+        ('fill_colors', np.uint8, (3,)),
+        ('has_fill', np.bool_, ()),
+        ('line_widths', np.int32, ()),
+        ('show_borders', np.bool_, ()),
+    )
+
+    def __init__(self, capacity=64, vertex_capacity=256):
+        self.count = 0
+        self.vertex_count = 0
+        self.vertices = np.empty((vertex_capacity, 2), dtype=np.float64)
+        self.offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self.types = np.empty(capacity, dtype=np.uint8)
+        self.border_colors = np.empty((capacity, 3), dtype=np.uint8)
+        self.fill_colors = np.empty((capacity, 3), dtype=np.uint8)
+        self.has_fill = np.empty(capacity, dtype=bool)
+        self.line_widths = np.empty(capacity, dtype=np.int32)
+        self.show_borders = np.empty(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('shape index out of range')
+        return ShapeView(self, index)
+
+    def __iter__(self):
+        return (ShapeView(self, i) for i in range(self.count))
+
+    def reserve(self, shapes, vertices):
+        ''' Grow the buffers, doubling, so they hold at least the given totals '''
+        if vertices > len(self.vertices):
+            size = max(vertices, 2 * len(self.vertices))
+            grown = np.empty((size, 2), dtype=np.float64)
+            grown[:self.vertex_count] = self.vertices[:self.vertex_count]
+            self.vertices = grown
+        if shapes > len(self.types):
+            size = max(shapes, 2 * len(self.types))
+            for name in ('types', 'border_colors', 'fill_colors', 'has_fill', 'line_widths', 'show_borders'):
+                old = getattr(self, name)
+                grown = np.empty((size,) + old.shape[1:], dtype=old.dtype)
+                grown[:self.count] = old[:self.count]
+                setattr(self, name, grown)
+            offsets = np.zeros(size + 1, dtype=np.int64)
+            offsets[:self.count + 1] = self.offsets[:self.count + 1]
+            self.offsets = offsets
+
+    def append(self, shape_type, points, border_color, line_width, fill_color, show_border):
+        ''' Add a shape and return its index '''
+        n = len(points)
+        self.reserve(self.count + 1, self.vertex_count + n)
+        i = self.count
+        self.vertices[self.vertex_count:self.vertex_count + n] = points
+        self.vertex_count += n
+        self.offsets[i + 1] = self.vertex_count
+        self.types[i] = self.type_names.index(shape_type)
+        self.border_colors[i] = tuple(border_color)[:3]
+        self.has_fill[i] = fill_color is not None
+        self.fill_colors[i] = tuple(fill_color)[:3] if fill_color is not None else (0, 0, 0)
+        self.line_widths[i] = line_width
+        self.show_borders[i] = show_border
+        self.count += 1
+        return i
+
+    def pop(self):
+        ''' Remove the last shape and return it as a plain list '''
+        shape = list(self[self.count - 1])
+        shape[1] = [tuple(p) for p in shape[1].tolist()]
+        self.count -= 1
+        self.vertex_count = int(self.offsets[self.count])
+        return shape
+
+    def copy(self):
+        ''' Return a compact copy, safe to read from a worker thread while this store keeps changing '''
+        store = ShapeStore(0, 0)
+        for name, dtype, tail in self.fields:
+            rows = self.vertex_count if name == 'vertices' else self.count + 1 if name == 'offsets' else self.count
+            setattr(store, name, getattr(self, name)[:rows].copy())
+        store.count = self.count
+        store.vertex_count = self.vertex_count
+        return store
+
+    def flattened(self, tolerance):
+        ''' Return a copy with every path's curves flattened into polygon vertices at the given tolerance '''
+        path_type = self.type_names.index('path')
+        if not np.any(self.types[:self.count] == path_type):
+            return self
+        store = ShapeStore(self.count, self.vertex_count)
+        for i, shape in enumerate(self):
+            points = flatten_cubics(shape.points, tolerance) if self.types[i] == path_type else shape.points
+            store.append(shape.type, points, shape.border_color, shape.line_width, shape.fill_color, shape.show_border)
+        return store
+
+    @classmethod
+    def layout(cls, count, vertex_count):
+        ''' Yield (name, dtype, shape, byte offset) for each array in a document with these totals '''
+        position = cls.header.size
+        for name, dtype, tail in cls.fields:
+            rows = vertex_count if name == 'vertices' else count + 1 if name == 'offsets' else count
+            shape = (rows,) + tail
+            yield name, dtype, shape, position
+            position += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+
+    def save(self, filename):
+        ''' Write a compacted snapshot of the store, replacing the file and any journal it had '''
+        layout = list(self.layout(self.count, self.vertex_count))
+        name, dtype, shape, position = layout[-1]
+        end = position + int(np.prod(shape)) * np.dtype(dtype).itemsize
+        end = -(-end // 8) * 8
+
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as file:
+            file.write(self.header.pack(self.magic, self.count, self.vertex_count, end))
+            for name, dtype, shape, position in layout:
+                file.seek(position)
+                rows = shape[0]
+                file.write(np.ascontiguousarray(getattr(self, name)[:rows], dtype=dtype).tobytes())
+            file.truncate(end)
+        os.replace(temp, filename)
+        return end
+
+    @classmethod
+    def load(cls, filename):
+        ''' Map a saved document and replay its journal, returns the store and the journal's end offset '''
+        with open(filename, 'rb') as file:
+            magic, count, vertex_count, end = cls.header.unpack(file.read(cls.header.size))
+            if magic != cls.magic:
+                raise ValueError(f'{filename} is not a drawing document')
+            file.seek(end)
+            journal = file.read()
+
+        store = cls(0, 0)
+        raw = np.memmap(filename, dtype=np.uint8, mode='c', shape=(end,)).view(np.ndarray)
+        for name, dtype, shape, position in cls.layout(count, vertex_count):
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            setattr(store, name, raw[position:position + size].view(dtype).reshape(shape))
+        store.count = count
+        store.vertex_count = vertex_count
+        return store, end + DocumentJournal.replay(store, journal)
+
+    def transformed(self, scale, ox, oy, index=None):
+        ''' Return vertices mapped by scale and offset, for one shape or the whole buffer '''
+        if index is None:
+            vertices = self.vertices[:self.vertex_count]
+        else:
+            vertices = self.vertices[self.offsets[index]:self.offsets[index + 1]]
+        return vertices * scale + (ox, oy)
+
+    def bounds(self):
+        ''' Per-shape (x0, y0, x1, y1) boxes, padded by line width where the border is shown '''
+        if not self.count:
+            return np.empty((0, 4))
+        vertices = self.vertices[:self.vertex_count]
+        starts = self.offsets[:self.count]
+        pad = np.where(self.show_borders[:self.count], self.line_widths[:self.count], 0)[:, None]
+        lo = np.minimum.reduceat(vertices, starts) - pad
+        hi = np.maximum.reduceat(vertices, starts) + pad
+        return np.hstack((lo, hi))
+
+class DocumentJournal:
+    ''' Append-only log of edits kept after a saved document's snapshot, so each edit is one small write '''
+    ADD, POP = 1, 2
+    add_record = struct.Struct('<BBIi3s3s??')
+
+    def __init__(self, filename, end):
+        self.file = open(filename, 'r+b')
+        # drop a torn record left by an interrupted write
+        self.file.truncate(end)
+        self.file.seek(end)
+
+    def write_add(self, store, shape_id):
+        shape = store[shape_id]
+        points = shape.points
+        self.file.write(self.add_record.pack(
+            self.ADD, store.types[shape_id], len(points), shape.line_width,
+            store.border_colors[shape_id].tobytes(), store.fill_colors[shape_id].tobytes(),
+            bool(store.has_fill[shape_id]), shape.show_border,
+        ))
+        self.file.write(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+        self.file.flush()
+
+    def write_pop(self):
+        self.file.write(bytes((self.POP,)))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @classmethod
+    def replay(cls, store, data):
+        ''' Apply journal records to a store, returns the number of bytes of complete records '''
+        position = 0
+        while position < len(data):
+            op = data[position]
+            if op == cls.POP:
+                store.pop()
+                position += 1
+                continue
+            if op != cls.ADD or position + cls.add_record.size > len(data):
+                break
+            _, type_code, n, line_width, border, fill, has_fill, show_border = cls.add_record.unpack_from(data, position)
+            start = position + cls.add_record.size
+            if start + n * 16 > len(data):
+                break
+            points = np.frombuffer(data, dtype=np.float64, count=n * 2, offset=start).reshape(n, 2)
+            fill_color = tuple(fill) if has_fill else None
+            store.append(store.type_names[type_code], points, tuple(border), line_width, fill_color, show_border)
+            position = start + n * 16
+        return position
+
+class History:
+    ''' Undo/redo stacks of small edit records, the oldest are evicted once they pass a memory cap '''
+    entry_overhead = 64
+
+    def __init__(self, max_bytes=1 << 22, merge_window=0.5):
+        self.max_bytes = max_bytes
+        self.merge_window = merge_window
+        self.undo_stack = deque()
+        self.redo_stack = deque()
+        self.bytes = 0
+        self.merge_key = None
+        self.last_record = 0.0
+
+    def entry_size(self, entry):
+        ''' Rough memory cost of an entry, its arrays plus a fixed overhead '''
+        return self.entry_overhead + sum(item.nbytes for item in entry if isinstance(item, np.ndarray))
+
+    def push(self, stack, entry):
+        stack.append(entry)
+        self.bytes += self.entry_size(entry)
+        self.evict()
+
+    def evict(self):
+        ''' Drop the oldest undo entries, then the furthest redo entries, until under the cap '''
+        while self.bytes > self.max_bytes and (self.undo_stack or self.redo_stack):
+            stack = self.undo_stack if self.undo_stack else self.redo_stack
+            self.bytes -= self.entry_size(stack.popleft())
+
+    def record(self, entry, merge_key=None):
+        ''' Add an edit, a run of edits sharing a merge key collapses into one entry keeping the first before state '''
+        now = time.time()
+        top = self.undo_stack[-1] if self.undo_stack else None
+        mergeable = merge_key is not None and merge_key == self.merge_key and now - self.last_record < self.merge_window
+        if mergeable and top is not None and top[0] == entry[0]:
+            merged = top[:-1] + entry[-1:]
+            if merged[-2] == merged[-1]:
+                # the run cancelled itself out, e.g. zooming in and back out
+                self.bytes -= self.entry_size(self.undo_stack.pop())
+            else:
+                self.undo_stack[-1] = merged
+        else:
+            while self.redo_stack:
+                self.bytes -= self.entry_size(self.redo_stack.pop())
+            self.push(self.undo_stack, entry)
+        self.merge_key = merge_key
+        self.last_record = now
+
+    def seal(self):
+        ''' Stop the next edit merging into the current entry '''
+        self.merge_key = None
+
+    def undo(self, apply):
+        ''' Reverse the latest edit with apply(entry), which returns the entry to keep for redo '''
+        if not self.undo_stack:
+            return False
+        entry = self.undo_stack.pop()
+        self.bytes -= self.entry_size(entry)
+        self.push(self.redo_stack, apply(entry))
+        self.seal()
+        return True
+
+    def redo(self, apply):
+        ''' Re-apply the latest undone edit with apply(entry), which returns the entry to keep for undo '''
+        if not self.redo_stack:
+            return False
+        entry = self.redo_stack.pop()
+        self.bytes -= self.entry_size(entry)
+        self.push(self.undo_stack, apply(entry))
+        self.seal()
+        return True
+
+class FrameProfiler:
+    ''' Per-stage frame timings over a rolling window, with shape and draw call counts and an optional trace file '''
+    stage_order = ('events', 'grid', 'shapes', 'ui', 'flip')
+
+    def __init__(self, window=240):
+        self.samples = deque(maxlen=window)
+        self.frame = 0
+        self.stages = {}
+        self.draw_calls = 0
+        self.frame_start = time.perf_counter()
+        self.trace_file = None
+        self.trace_writer = None
+        self.trace_filename = None
+
+    def begin_frame(self):
+        self.stages = dict.fromkeys(self.stage_order, 0.0)
+        self.draw_calls = 0
+        self.frame_start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        ''' Add the time spent in the block to a stage of the current frame '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def end_frame(self, **counts):
+        ''' Close the frame, keep its sample in the window and write it to the trace file if recording '''
+        sample = {'frame': self.frame, 'time': time.time(), 'total': time.perf_counter() - self.frame_start}
+        sample.update(self.stages)
+        sample['draw_calls'] = self.draw_calls
+        sample.update(counts)
+        self.samples.append(sample)
+        self.frame += 1
+        if self.trace_file is not None:
+            if self.trace_filename.endswith('.csv'):
+                if self.trace_writer is None:
+                    self.trace_writer = csv.DictWriter(self.trace_file, fieldnames=list(sample))
+                    self.trace_writer.writeheader()
+                self.trace_writer.writerow(sample)
+            else:
+                self.trace_file.write(json.dumps(sample) + '\n')
+
+    def percentiles(self, key, q=(50, 95, 99)):
+        ''' Percentiles of one sample field over the window '''
+        if not self.samples:
+            return [0.0] * len(q)
+        return np.percentile([sample[key] for sample in self.samples], q).tolist()
+
+    def start_recording(self, filename):
+        ''' Record every following frame to a CSV file, or JSON lines for any other extension '''
+        self.stop_recording()
+        self.trace_filename = filename
+        self.trace_file = open(filename, 'w', newline='')
+
+    def stop_recording(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            print('Frame trace written to:', self.trace_filename)
+        self.trace_file = None
+        self.trace_writer = None
+
+DIALOG_SCRIPT = '''
+import json, sys, tkinter as tk
 from tkinter import filedialog
+root = tk.Tk()
+root.withdraw()
+print(getattr(filedialog, sys.argv[1])(**json.loads(sys.argv[2])) or '')
+'''
+
+def ask_path(job, dialog, **options):
+    ''' Show a tkinter file dialog in a child process so the pygame loop keeps running, returns '' when dismissed '''
+    process = subprocess.Popen([sys.executable, '-c', DIALOG_SCRIPT, dialog, json.dumps(options)], stdout=subprocess.PIPE, text=True)
+    job.process = process
+    output, _ = process.communicate()
+    job.process = None
+    job.report(job.progress)
+    return output.strip()
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    ''' A unit of background work, the worker reports progress and stops at the next report once cancelled '''
+    def __init__(self, name):
+        self.name = name
+        self.progress = 0.0
+        self.cancelled = threading.Event()
+        self.process = None
+
+    def report(self, progress):
+        self.progress = progress
+        if self.cancelled.is_set():
+            raise JobCancelled(self.name)
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.process is not None:
+            self.process.kill()
+
+class JobQueue:
+    ''' Runs jobs on a worker thread pool, results come back through a queue drained on the main thread '''
+    def __init__(self, workers=2, wake=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.results = queue.Queue()
+        self.jobs = []
+        self.wake = wake
+
+    def submit(self, name, work, on_done=None, on_error=None):
+        ''' Run work(job) in the background, on_done(result) or on_error(exception) are called from drain '''
+        job = Job(name)
+        self.jobs.append(job)
+        self.pool.submit(self.run, job, work, on_done, on_error)
+        return job
+
+    def run(self, job, work, on_done, on_error):
+        try:
+            self.results.put((job, on_done, work(job)))
+        except Exception as e:
+            self.results.put((job, on_error, e))
+        if self.wake is not None:
+            self.wake()
+
+    def drain(self):
+        ''' Hand finished jobs' results to their callbacks, returns the number of jobs finished '''
+        finished = 0
+        while True:
+            try:
+                job, callback, result = self.results.get_nowait()
+            except queue.Empty:
+                return finished
+            self.jobs.remove(job)
+            finished += 1
+            if isinstance(result, JobCancelled):
+                print('Cancelled:', job.name)
+            if callback is not None:
+                callback(result)
+            elif isinstance(result, Exception) and not isinstance(result, JobCancelled):
+                print(f'{job.name} failed: {result}')
+
+    def running(self, name):
+        ''' Whether a job of this name is still in flight '''
+        return any(job.name == name for job in self.jobs)
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def shutdown(self):
+        self.cancel_all()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+class SpatialGrid:
+    ''' Uniform grid of world-space cells listing the ids of shapes whose bounding box overlaps each cell '''
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.bounds = {}
+
+    def cell_range(self, x0, y0, x1, y1):
+        ''' Yield the cell keys covering a world rectangle '''
+        size = self.cell_size
+        for cx in range(int(x0 // size), int(x1 // size) + 1):
+            for cy in range(int(y0 // size), int(y1 // size) + 1):
+                yield cx, cy
+
+    def add(self, shape_id, bounds):
+        ''' Index a shape by its (x0, y0, x1, y1) bounding box '''
+        self.bounds[shape_id] = bounds
+        for key in self.cell_range(*bounds):
+            self.cells.setdefault(key, []).append(shape_id)
+
+    def remove(self, shape_id):
+        ''' Drop a shape from every cell it was indexed in '''
+        bounds = self.bounds.pop(shape_id, None)
+        if bounds is None:
+            return
+        for key in self.cell_range(*bounds):
+            ids = self.cells[key]
+            ids.remove(shape_id)
+            if not ids:
+                del self.cells[key]
+
+    def clear(self):
+        ''' Remove every shape from the index '''
+        self.cells.clear()
+        self.bounds.clear()
+
+    def query(self, x0, y0, x1, y1):
+        ''' Return the ids of shapes whose bounding box intersects the rectangle, in drawing order '''
+        found = set()
+        cells = self.cells
+        for key in self.cell_range(x0, y0, x1, y1):
+            ids = cells.get(key)
+            if ids:
+                found.update(ids)
+
+        hits = []
+        for shape_id in found:
+            bx0, by0, bx1, by1 = self.bounds[shape_id]
+            if bx0 <= x1 and bx1 >= x0 and by0 <= y1 and by1 >= y0:
+                hits.append(shape_id)
+        hits.sort()
+        return hits
+
+class EventRouter:
+    ''' Routes pygame events to handlers by event type, and clicks through a grid-indexed table of hit regions '''
+    coalesced = (pygame.MOUSEMOTION, pygame.MOUSEWHEEL)
+
+    def __init__(self, cell_size=64):
+        self.handlers = {}
+        self.region_ids = {}
+        self.region_rects = {}
+        self.region_handlers = {}
+        self.hit_grid = SpatialGrid(cell_size)
+
+    def on(self, event_type, handler):
+        ''' Call handler(event) for every event of this type '''
+        self.handlers.setdefault(event_type, []).append(handler)
+
+    def add_region(self, name, handler, rect=(0, 0, 0, 0)):
+        ''' Register a clickable region, regions registered first are called first '''
+        self.region_ids[name] = region_id = len(self.region_ids)
+        self.region_handlers[region_id] = handler
+        self.move_region(name, rect)
+
+    def move_region(self, name, rect):
+        ''' Update where a region sits on screen '''
+        region_id = self.region_ids[name]
+        rect = pygame.Rect(rect)
+        if self.region_rects.get(region_id) == rect:
+            return
+        self.region_rects[region_id] = rect
+        self.hit_grid.remove(region_id)
+        if rect.width > 0 and rect.height > 0:
+            self.hit_grid.add(region_id, (rect.left, rect.top, rect.right - 1, rect.bottom - 1))
+
+    def hit_test(self, pos):
+        ''' Return the ids of the regions containing a screen position '''
+        x, y = pos
+        return [i for i in self.hit_grid.query(x, y, x, y) if self.region_rects[i].collidepoint(x, y)]
+
+    def coalesce(self, events):
+        ''' Merge each run of mouse motion (with unchanged buttons) or wheel events into a single event '''
+        merged = []
+        for event in events:
+            last = merged[-1] if merged else None
+            if last is None or event.type != last.type or event.type not in self.coalesced:
+                merged.append(event)
+            elif event.type == pygame.MOUSEMOTION and event.buttons == last.buttons:
+                rel = (last.rel[0] + event.rel[0], last.rel[1] + event.rel[1])
+                merged[-1] = pygame.event.Event(pygame.MOUSEMOTION, pos=event.pos, rel=rel, buttons=event.buttons)
+            elif event.type == pygame.MOUSEWHEEL:
+                merged[-1] = pygame.event.Event(pygame.MOUSEWHEEL, x=last.x + event.x, y=last.y + event.y)
+            else:
+                merged.append(event)
+        return merged
+
+    def dispatch(self, events):
+        ''' Coalesce a frame's events and send each one to its handlers '''
+        for event in self.coalesce(events):
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                for region_id in self.hit_test(event.pos):
+                    self.region_handlers[region_id](event)
+            for handler in self.handlers.get(event.type, ()):
+                handler(event)
 
 class DrawApp:
-    def __init__(self):
+    tk_kinds = {'rectangle': 1, 'circle': 2}
+    JOB_DONE = pygame.USEREVENT + 1
+
+    def __init__(self, max_fps=60, idle_timeout=500, window_size=(800, 600), headless=False):
+        if headless:
+            # render into an offscreen display, no window is opened
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
         pygame.init()
-        self.window_size = (800, 600)
+        self.window_size = tuple(window_size)
         self.screen = pygame.display.set_mode(self.window_size)
         pygame.display.set_caption('Drawing Window')
         self.font = pygame.font.SysFont(None, 24)
         self.small_font = pygame.font.SysFont(None, 18)
         self.clicks = []
-        self.shapes = []
+        self.shapes = ShapeStore()
+        self.shape_index = SpatialGrid()
+        self.document_path = None
+        self.journal = None
+        self.history = History()
+        self.scene_layer = pygame.Surface(self.window_size).convert()
+        self.scene_key = None
+        self.scene_version = 0
+
+        self.clock = pygame.time.Clock()
+        self.profiler = FrameProfiler()
+        self.export_mode = 'auto'
+        self.export_packed_threshold = 1000
+        self.jobs = JobQueue(wake=lambda: pygame.event.post(pygame.event.Event(self.JOB_DONE)))
+        self.jobs_rect = pygame.Rect(self.window_size[0] // 2 - 160, 5, 320, 20)
+        self.jobs_shown = False
+        self.trace_quality = 0.5
+        # traced paths keep their curves, flattened per zoom level to within path_tolerance screen pixels
+        self.path_tolerance = 0.5
+        self.path_max_level = 8
+        self.path_lod = OrderedDict()
+        self.path_lod_levels = 4
+        self.drawn_vertex_count = 0
+        self.save_state = None
+        self.show_hud = False
+        self.hud_rect = pygame.Rect(5, 5, 420, 100)
+        self.visible_count = 0
+        self.max_fps = max_fps
+        self.idle_timeout = idle_timeout
+        self.frame_layer = pygame.Surface(self.window_size).convert()
+        self.frame_key = None
+        self.frame_panels = None
+        self.cursor_rect = None
+        self.label_cache = {}
+        self.label_cache_size = 256
         self.selection_points = []
         self.line_width = 5
 
@@ -26,6 +713,13 @@ class DrawApp:
         self.zoom_level = 1
 
         self.grid_spacing = 10
+        self.grid_min_spacing = 6
+        self.grid_major_every = 5
+        self.grid_layer_max_spacing = 40
+        self.grid_color = (180, 180, 180)
+        self.grid_key_color = (255, 0, 255)
+        self.grid_layer = None
+        self.grid_layer_key = None
         self.grid_offset_x = 0.0
         self.grid_offset_y = 0.0
 
@@ -44,60 +738,262 @@ class DrawApp:
         self.build_palette()
 
         self.sv_size = (100, 100)
+        self.sv_hue_step = 0.5
+        self.sv_cache = OrderedDict()
+        self.sv_cache_size = 64
         self.sv_surface = pygame.Surface(self.sv_size)
         self.sv_rect = self.sv_surface.get_rect()
         self.sv_rect.bottomright = (self.window_size[0] - 200, self.window_size[1] - 40)
         self.sv_cursor_pos = None
         self.build_sv_box()
+        self.labels_rect = pygame.Rect(self.window_size[0] - 172 - 5, self.window_size[1] - 130 - 35, 172, 130)
+
+        box_margin = 5
+        box_width = 35
+        box_height = 35
+        box_y = self.palette_rect.top - box_height - box_margin
+        self.shape_box_rects = [
+            pygame.Rect(box_margin + i * (box_width + box_margin), box_y, box_width, box_height)
+            for i in range(3)
+        ]
 
-        self.grid_toggle_rect = pygame.Rect(0, 0, 0, 0)
-        self.border_label_rect = pygame.Rect(0, 0, 0, 0)
-        self.background_label_rect = pygame.Rect(0, 0, 0, 0)
-        self.border_toggle_rect = pygame.Rect(0, 0, 0, 0)
-        self.canvas_label_rect = pygame.Rect(0, 0, 0, 0)
-        self.export_label_rect = pygame.Rect(0, 0, 0, 0)
+        self.running = True
+        self.router = EventRouter()
+        self.router.on(pygame.QUIT, self.handle_quit)
+        self.router.on(pygame.VIDEOEXPOSE, self.handle_expose)
+        self.router.on(pygame.WINDOWEXPOSED, self.handle_expose)
+        self.router.on(pygame.MOUSEBUTTONDOWN, self.handle_canvas_click)
+        self.router.on(pygame.MOUSEMOTION, self.handle_panning)
+        self.router.on(pygame.MOUSEWHEEL, self.handle_zoom)
+        self.router.on(pygame.MOUSEBUTTONUP, lambda event: self.history.seal())
+        self.router.on(pygame.KEYDOWN, self.handle_line_thickness)
+        self.router.on(pygame.KEYDOWN, lambda event: self.handle_undo(event, pygame.key.get_mods()))
+        self.router.on(pygame.KEYDOWN, self.handle_save)
+        self.router.on(pygame.KEYDOWN, self.handle_profiler_keys)
+        self.router.on(pygame.KEYDOWN, self.handle_job_keys)
+
+        self.router.add_region('border_label', lambda event: self.set_color_mode('border'))
+        self.router.add_region('background_label', lambda event: self.set_color_mode('background'))
+        self.router.add_region('canvas_label', lambda event: self.set_color_mode('canvas'))
+        self.router.add_region('palette', self.handle_hue_pick, self.palette_rect)
+        self.router.add_region('sv_box', self.handle_sv_pick, self.sv_rect)
+        self.router.add_region('border_toggle', self.handle_border_toggle_click)
+        self.router.add_region('grid_toggle', self.handle_grid_toggle_click)
+        for name, rect in zip(('triangle', 'rectangle', 'circle'), self.shape_box_rects):
+            self.router.add_region(name, lambda event, name=name: self.select_shape(name), rect)
+        self.router.add_region('export', self.handle_export_click)
 
     def build_palette(self):
         ''' Create a horizontal color palette surface (hue bar). '''
         w, h = self.palette_size
-        for x in range(w):
-            hue = (x / (w - 1)) * 360.0
-            sat = 100.0
-            val = 100.0
-            c = pygame.Color(0, 0, 0)
-            c.hsva = (hue, sat, val, 100)
-            for y in range(h):
-                self.palette_surface.set_at((x, y), c)
+        hue = (np.arange(w) / (w - 1)) * 360.0
+        row = hsv_to_rgb(hue, 100.0, 100.0)
+        pygame.surfarray.blit_array(self.palette_surface, np.repeat(row[:, None], h, axis=1))
 
     def build_sv_box(self):
-        ''' Build the 2D saturation/value box for the current hue. '''
-        w, h = self.sv_size
-        for x in range(w):
-            sat = (x / (w - 1)) * 100.0
-            for y in range(h):
-                val = 100.0 - (y / (h - 1)) * 100.0
-                c = pygame.Color(0, 0, 0)
-                c.hsva = (self.current_hue, sat, val, 100)
-                self.sv_surface.set_at((x, y), c)
+        ''' Build the 2D saturation/value box for the current hue, reusing recently built boxes. '''
+        key = round(self.current_hue / self.sv_hue_step)
+        surface = self.sv_cache.get(key)
+        if surface is None:
+            w, h = self.sv_size
+            sat = (np.arange(w) / (w - 1)) * 100.0
+            val = 100.0 - (np.arange(h) / (h - 1)) * 100.0
+            surface = pygame.surfarray.make_surface(hsv_to_rgb(key * self.sv_hue_step, sat[:, None], val[None, :]))
+            self.sv_cache[key] = surface
+            if len(self.sv_cache) > self.sv_cache_size:
+                self.sv_cache.popitem(last=False)
+        else:
+            self.sv_cache.move_to_end(key)
+        self.sv_surface = surface
+
+    def to_screen(self, points):
+        ''' Map world coordinates to screen coordinates through the current zoom and pan '''
+        if not len(points):
+            return []
+        return (np.asarray(points, dtype=np.float64) * self.zoom_level + (self.grid_offset_x, self.grid_offset_y)).tolist()
+
+    def to_world(self, pos):
+        ''' Map a screen position back to world coordinates '''
+        x, y = pos
+        return ((x - self.grid_offset_x) / self.zoom_level, (y - self.grid_offset_y) / self.zoom_level)
+
+    def create_shape(self, shape_type, points):
+        ''' Add a newly drawn shape as an undoable edit '''
+        self.add_shape(shape_type, points)
+        self.history.record(('add', None))
+
+    def add_shape(self, shape_type, points, style=None):
+        ''' Add a shape to the drawing and the spatial index, styled with the current colours and line width by default '''
+        border_color, line_width, fill_color, show_border = style or (self.color, self.line_width, self.fill_color, self.show_border)
+        shape_id = self.shapes.append(shape_type, points, border_color, line_width, fill_color, show_border)
+        self.shape_index.add(shape_id, self.shape_bounds(shape_id))
+        if self.journal is not None:
+            self.journal.write_add(self.shapes, shape_id)
+        self.scene_version += 1
+        if self.scene_key == self.current_scene_key():
+            self.draw_shapes(self.scene_layer, [shape_id])
+
+    def shape_bounds(self, shape_id):
+        ''' World-space bounding box of one shape, padded by its line width '''
+        points = self.shapes[shape_id].points
+        pad = self.shapes.line_widths[shape_id] if self.shapes.show_borders[shape_id] else 0
+        (x0, y0), (x1, y1) = points.min(axis=0) - pad, points.max(axis=0) + pad
+        return (float(x0), float(y0), float(x1), float(y1))
+
+    def rebuild_index(self):
+        ''' Re-index every shape from the store's vectorised bounds '''
+        self.shape_index.clear()
+        for shape_id, bounds in enumerate(self.shapes.bounds().tolist()):
+            self.shape_index.add(shape_id, tuple(bounds))
+
+    def pop_shape(self):
+        ''' Remove the most recent shape from the drawing and the spatial index '''
+        self.shape_index.remove(len(self.shapes) - 1)
+        for cache in self.path_lod.values():
+            cache.pop(len(self.shapes) - 1, None)
+        self.scene_key = None
+        self.scene_version += 1
+        if self.journal is not None:
+            self.journal.write_pop()
+        shape = self.shapes.pop()
+        if self.save_state is not None:
+            self.save_state['low'] = min(self.save_state['low'], len(self.shapes))
+        return shape
+
+    def open_document(self, filename, journal=True):
+        ''' Load a saved drawing, or start a new one at this path, and journal further edits to it '''
+        if os.path.exists(filename):
+            self.shapes, end = ShapeStore.load(filename)
+        else:
+            self.shapes = ShapeStore()
+            end = self.shapes.save(filename)
+        self.document_path = filename
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if journal:
+            self.journal = DocumentJournal(filename, end)
+        self.rebuild_index()
+        self.path_lod.clear()
+        self.scene_key = None
+        self.scene_version += 1
+        print('Opened:', filename, len(self.shapes), 'shapes')
+
+    def import_svg(self, filename):
+        ''' Add the paths of an ImageTracer SVG as filled path shapes, undone as one edit. Paths of a tiled trace
+        that cross a tile's clip edge are kept whole, so their overlap margin shows past the seam '''
+        from trace import read_svg_paths, parse_path
+        count = 0
+        for d, rgb, offset, clip in read_svg_paths(filename):
+            for start, segments in parse_path(d):
+                if not segments:
+                    continue
+                controls = cubic_controls(start, segments, offset)
+                # tiles of a tiled trace overlap, skip the copies lying wholly in a neighbour's margin
+                if clip is not None:
+                    (x0, y0), (x1, y1) = controls.min(axis=0), controls.max(axis=0)
+                    if x1 <= clip[0] or y1 <= clip[1] or x0 >= clip[2] or y0 >= clip[3]:
+                        continue
+                self.add_shape('path', controls, (rgb, 1, rgb, False))
+                count += 1
+        if count:
+            self.history.record(('import', count))
+        print('Imported:', filename, count, 'paths')
+        return count
+
+    def path_level(self):
+        ''' Level of detail for the current zoom, one level per doubling '''
+        return min(self.zoom_level.bit_length() - 1, self.path_max_level)
+
+    def path_points(self, shape_id, level=None):
+        ''' World-space polygon of a path shape at a level of detail, cached per level '''
+        level = self.path_level() if level is None else level
+        cache = self.path_lod.get(level)
+        if cache is None:
+            cache = self.path_lod[level] = {}
+            if len(self.path_lod) > self.path_lod_levels:
+                self.path_lod.popitem(last=False)
+        else:
+            self.path_lod.move_to_end(level)
+        points = cache.get(shape_id)
+        if points is None:
+            points = cache[shape_id] = flatten_cubics(self.shapes[shape_id].points, self.path_tolerance / (1 << level))
+        return points
+
+    def fit_view(self, margin=20):
+        ''' Centre the drawing in the window at the largest whole zoom level that fits it '''
+        if not len(self.shapes):
+            return
+        bounds = self.shapes.bounds()
+        x0, y0 = bounds[:, :2].min(axis=0)
+        x1, y1 = bounds[:, 2:].max(axis=0)
+        width, height = self.window_size
+        scale = min((width - 2 * margin) / max(x1 - x0, 1), (height - 2 * margin) / max(y1 - y0, 1))
+        self.zoom_level = max(1, int(scale))
+        self.grid_offset_x = float(width / 2 - (x0 + x1) / 2 * self.zoom_level)
+        self.grid_offset_y = float(height / 2 - (y0 + y1) / 2 * self.zoom_level)
+
+    def render_png(self, filename, ui=False):
+        ''' Rasterize the drawing at the current view to a PNG, optionally with the tool UI around it '''
+        self.draw_scene()
+        if ui:
+            self.draw_ui()
+        pygame.image.save(self.screen, filename)
+        print('Rendered to:', filename)
+
+    def visible_shapes(self):
+        ''' Return the ids of shapes intersecting the window, in drawing order '''
+        x0, y0 = self.to_world((0, 0))
+        x1, y1 = self.to_world(self.window_size)
+        return self.shape_index.query(x0, y0, x1, y1)
+
+    def shape_at(self, pos):
+        ''' Return the id of the topmost shape under a screen position, or None '''
+        x, y = self.to_world(pos)
+        for shape_id in reversed(self.shape_index.query(x, y, x, y)):
+            shape = self.shapes[shape_id]
+            shape_type, points = shape.type, shape.points.tolist()
+            if shape_type == 'path':
+                points = self.path_points(shape_id).tolist()
+            if shape_type == 'circle':
+                xs = [p[0] for p in points]
+                ys = [p[1] for p in points]
+                cx, cy = (min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2
+                rx, ry = (max(xs) - min(xs)) / 2, (max(ys) - min(ys)) / 2
+                if rx > 0 and ry > 0 and ((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2 <= 1:
+                    return shape_id
+            elif self.point_in_polygon(x, y, points):
+                return shape_id
+        return None
+
+    def point_in_polygon(self, x, y, points):
+        ''' Even-odd ray casting test '''
+        inside = False
+        j = len(points) - 1
+        for i in range(len(points)):
+            xi, yi = points[i]
+            xj, yj = points[j]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+        return inside
 
     def handle_draw_shape(self, event):
         '''Record clicks and add a shape to the stack when enough points are collected. '''
-        x, y = event.pos
+        x, y = self.to_world(event.pos)
         self.clicks.append((x, y))
         self.selection_points.append((x, y))
         self.last_click = time.time()
 
         # triangle
         if self.selected_shape == 'triangle' and len(self.clicks) == 3:
-            shape = ['triangle', self.clicks, self.color, self.line_width, self.fill_color, self.show_border]
-            self.shapes.append(shape)
+            self.create_shape('triangle', self.clicks)
             self.clicks = []
             self.selection_points = []
 
         # rectangle
         elif self.selected_shape == 'rectangle' and len(self.clicks) == 4:
-            shape = ['rectangle', self.clicks, self.color, self.line_width, self.fill_color, self.show_border]
-            self.shapes.append(shape)
+            self.create_shape('rectangle', self.clicks)
             self.clicks = []
             self.selection_points = []
         
@@ -115,21 +1011,47 @@ class DrawApp:
             bottom = cy + half_height
 
             points = [
-                (int(left),  int(top)),
-                (int(right), int(top)),
-                (int(right), int(bottom)),
-                (int(left),  int(bottom)),
+                (left,  top),
+                (right, top),
+                (right, bottom),
+                (left,  bottom),
             ]
 
-            shape = ['circle', points, self.color, self.line_width, self.fill_color, self.show_border]
-            self.shapes.append(shape)
+            self.create_shape('circle', points)
             self.clicks = []
             self.selection_points = []
     
-    def draw_shapes(self):
-        '''Draw all shapes (triangles, rectangles, ovals) and selection points.'''
-        for shape in self.shapes:
-            shape_type, points, border_color, line_width, fill_color, show_border = shape
+    def current_scene_key(self):
+        ''' Everything the cached scene layer depends on besides the shapes themselves '''
+        return (self.window_size, self.zoom_level, self.grid_offset_x, self.grid_offset_y,
+                self.canvas_color, self.show_grid, self.grid_spacing)
+
+    def draw_scene(self):
+        ''' Blit the cached background, grid and shapes, re-rendering them only when the view has changed '''
+        key = self.current_scene_key()
+        if key != self.scene_key:
+            with self.profiler.stage('grid'):
+                self.scene_layer.fill(self.canvas_color)
+                self.draw_grid_lines(self.scene_layer)
+            with self.profiler.stage('shapes'):
+                visible = self.visible_shapes()
+                self.visible_count = len(visible)
+                self.drawn_vertex_count = 0
+                self.draw_shapes(self.scene_layer, visible)
+            self.scene_key = key
+        with self.profiler.stage('shapes'):
+            self.screen.blit(self.scene_layer, (0, 0))
+            self.profiler.draw_calls += 1
+
+    def draw_shapes(self, surface, shape_ids):
+        '''Draw the shapes (triangles, rectangles, ovals, traced paths) onto a surface.'''
+        for shape_id in shape_ids:
+            shape_type, points, border_color, line_width, fill_color, show_border = self.shapes[shape_id]
+            if shape_type == 'path':
+                points = (self.path_points(shape_id) * self.zoom_level + (self.grid_offset_x, self.grid_offset_y)).tolist()
+            else:
+                points = self.shapes.transformed(self.zoom_level, self.grid_offset_x, self.grid_offset_y, shape_id).tolist()
+            self.drawn_vertex_count += len(points)
 
             if shape_type == 'circle':
                 xs = [p[0] for p in points]
@@ -139,43 +1061,171 @@ class DrawApp:
                 rect = pygame.Rect(left, top, right - left, bottom - top)
 
                 if fill_color is not None:
-                    pygame.draw.ellipse(self.screen, fill_color, rect, 0)
+                    pygame.draw.ellipse(surface, fill_color, rect, 0)
+                    self.profiler.draw_calls += 1
                 if show_border:
-                    pygame.draw.ellipse(self.screen, border_color, rect, line_width)
+                    pygame.draw.ellipse(surface, border_color, rect, line_width)
+                    self.profiler.draw_calls += 1
 
             else:
                 if fill_color is not None:
-                    pygame.draw.polygon(self.screen, fill_color, points, 0)
+                    pygame.draw.polygon(surface, fill_color, points, 0)
+                    self.profiler.draw_calls += 1
                 if show_border:
-                    pygame.draw.polygon(self.screen, border_color, points, line_width)
+                    pygame.draw.polygon(surface, border_color, points, line_width)
+                    self.profiler.draw_calls += 1
 
-        for point in self.selection_points:
+    def draw_selection(self):
+        ''' Draw the pending selection points '''
+        for point in self.to_screen(self.selection_points):
             pygame.draw.circle(self.screen, self.color, point, self.line_width)
 
+    def expire_selection(self):
+        ''' Drop the pending selection points after a 3 second gap '''
         if time.time() - self.last_click > 3:
             self.selection_points = []
             self.clicks = []
         self.last_click = time.time()
     
     def draw_cursor(self):
-        ''' Draw a circle at the mouse position to represent the cursor '''
-        pygame.draw.circle(self.screen, self.color, pygame.mouse.get_pos(), self.line_width)
+        ''' Draw a circle at the mouse position to represent the cursor, returning its screen rect '''
         pygame.mouse.set_visible(False)
+        return pygame.draw.circle(self.screen, self.color, pygame.mouse.get_pos(), self.line_width)
+
+    def render_label(self, text, color, font=None):
+        ''' Return a rendered text surface, cached by font, text and colour '''
+        font = font or self.font
+        key = (font, text, tuple(color))
+        surface = self.label_cache.get(key)
+        if surface is None:
+            if len(self.label_cache) >= self.label_cache_size:
+                self.label_cache.clear()
+            surface = self.label_cache[key] = font.render(text, True, color)
+        return surface
+
+    def current_frame_key(self):
+        ''' Everything the composed frame depends on besides the UI panels, a change redraws the whole window '''
+        return (self.current_scene_key(), self.scene_version)
+
+    def ui_panels(self):
+        ''' Each tool UI panel as (state it is drawn from, screen rects it covers) '''
+        radius = self.line_width
+        selection = [pygame.Rect(x - radius, y - radius, 2 * radius + 1, 2 * radius + 1) for x, y in self.to_screen(self.selection_points)]
+        return [
+            ((tuple(self.selection_points), self.color, self.line_width), selection),
+            ((self.current_hue, self.sv_cursor_pos), [self.sv_rect.inflate(10, 10)]),
+            ((self.line_width, self.show_grid, self.show_border, self.color, self.fill_color, self.color_mode), [self.labels_rect]),
+            ((self.palette_cursor_x,), [self.palette_rect.inflate(4, 2)]),
+            ((self.selected_shape, self.color, self.fill_color), [self.shape_box_rects[0].unionall(self.shape_box_rects[1:])]),
+        ]
+
+    def draw_ui(self):
+        ''' Draw the tool UI over the scene '''
+        self.draw_selection()
+        self.draw_sv_box()
+        self.draw_labels()
+        self.draw_palette()
+        self.draw_export_label()
+        self.draw_shape_labels()
+
+    def draw_frame(self):
+        ''' Compose the frame and push only the changed regions to the display '''
+        key = self.current_frame_key()
+        panels = self.ui_panels()
+        if key != self.frame_key:
+            self.draw_scene()
+            with self.profiler.stage('ui'):
+                self.draw_ui()
+                self.frame_layer.blit(self.screen, (0, 0))
+            self.frame_key = key
+            dirty = [self.screen.get_rect()]
+        else:
+            # recompose only the panels whose state changed, over the cached scene
+            dirty = []
+            for (state, rects), (old_state, old_rects) in zip(panels, self.frame_panels):
+                if state != old_state:
+                    dirty += rects + [rect for rect in old_rects if rect not in rects]
+            with self.profiler.stage('ui'):
+                for rect in dirty:
+                    self.screen.set_clip(rect)
+                    self.screen.blit(self.scene_layer, rect, rect)
+                    self.draw_ui()
+                    self.frame_layer.blit(self.screen, rect, rect)
+                self.screen.set_clip(None)
+            if self.cursor_rect is not None:
+                self.screen.blit(self.frame_layer, self.cursor_rect, self.cursor_rect)
+                dirty.append(self.cursor_rect)
+        self.frame_panels = panels
+
+        with self.profiler.stage('ui'):
+            if self.show_hud:
+                self.screen.blit(self.frame_layer, self.hud_rect, self.hud_rect)
+                self.draw_hud()
+                dirty.append(self.hud_rect)
+            if self.jobs.jobs or self.jobs_shown:
+                self.screen.blit(self.frame_layer, self.jobs_rect, self.jobs_rect)
+                if self.jobs.jobs:
+                    self.draw_jobs()
+                self.jobs_shown = bool(self.jobs.jobs)
+                dirty.append(self.jobs_rect)
+            self.cursor_rect = self.draw_cursor()
+            dirty.append(self.cursor_rect)
+        with self.profiler.stage('flip'):
+            pygame.display.update(dirty)
+
+    def draw_hud(self):
+        ''' Draw the profiling overlay, frame time percentiles, the last frame's stages and counts '''
+        pygame.draw.rect(self.screen, (255, 255, 255), self.hud_rect)
+        pygame.draw.rect(self.screen, (0, 0, 0), self.hud_rect, 1)
+        self.draw_mouse_position()
+
+        last = self.profiler.samples[-1] if self.profiler.samples else {}
+        p50, p95, p99 = (v * 1000 for v in self.profiler.percentiles('total'))
+        stages = '  '.join(f'{name} {last.get(name, 0.0) * 1000:.2f}' for name in self.profiler.stage_order)
+        lines = [
+            f'frame {last.get("total", 0.0) * 1000:.2f} ms   p50 {p50:.2f}  p95 {p95:.2f}  p99 {p99:.2f}   {self.clock.get_fps():.0f} fps',
+            stages,
+            f'shapes {len(self.shapes)} ({self.visible_count} visible)  vertices {self.shapes.vertex_count} ({self.drawn_vertex_count} drawn)  draw calls {last.get("draw_calls", 0)}',
+        ]
+        if self.profiler.trace_file is not None:
+            lines.append(f'recording {self.profiler.trace_filename}')
+
+        y = self.hud_rect.top + 20
+        for line in lines:
+            # these change every frame, so they skip the label cache
+            self.screen.blit(self.small_font.render(line, True, (0, 0, 0)), (self.hud_rect.left + 5, y))
+            y += 18
+
+    def draw_jobs(self):
+        ''' Draw a status bar for the running background jobs '''
+        text = '   '.join(f'{job.name} {job.progress:.0%}' for job in self.jobs.jobs) + '   (Esc to cancel)'
+        pygame.draw.rect(self.screen, (255, 255, 255), self.jobs_rect)
+        pygame.draw.rect(self.screen, (0, 0, 0), self.jobs_rect, 1)
+        label = self.small_font.render(text, True, (0, 0, 0))
+        self.screen.blit(label, label.get_rect(center=self.jobs_rect.center))
+
+    def handle_profiler_keys(self, event):
+        ''' F3 toggles the profiling overlay, F4 starts or stops recording frames to a CSV trace '''
+        if event.key == pygame.K_F3:
+            self.show_hud = not self.show_hud
+            self.frame_key = None
+        elif event.key == pygame.K_F4:
+            if self.profiler.trace_file is None:
+                self.profiler.start_recording(time.strftime('frames-%Y%m%d-%H%M%S.csv'))
+            else:
+                self.profiler.stop_recording()
     
     def draw_labels(self):
         ''' Draw labels for line width, border toggle, and color modes '''
         
-        box_width = 172
-        box_height = 130
-        box_x = self.window_size[0] - box_width - 5
-        box_y = self.window_size[1] - box_height - 35
+        box_x, box_y, box_width, box_height = self.labels_rect
 
         pygame.draw.rect(self.screen, (255, 255, 255), (box_x, box_y, box_width, box_height))
         pygame.draw.rect(self.screen, (0, 0, 0), (box_x, box_y, box_width, box_height), 2)
 
         base_x = self.window_size[0] - 150 - 7
 
-        lw_label = self.font.render(f'line width: {self.line_width}', True, (0, 0, 0))
+        lw_label = self.render_label(f'line width: {self.line_width}', (0, 0, 0))
         lw_rect = lw_label.get_rect()
         lw_rect.bottomleft = (base_x, self.window_size[1] - 40)
         self.screen.blit(lw_label, lw_rect)
@@ -185,7 +1235,7 @@ class DrawApp:
         else:
             grid_text = 'grid: off'
 
-        grid_label = self.font.render(grid_text, True, (0, 0, 0))
+        grid_label = self.render_label(grid_text, (0, 0, 0))
         grid_rect = grid_label.get_rect()
         grid_rect.bottomleft = (base_x, lw_rect.top - 5)
         self.screen.blit(grid_label, grid_rect)
@@ -195,7 +1245,7 @@ class DrawApp:
         else:
             toggle_text = 'border: off'
 
-        toggle_label = self.font.render(toggle_text, True, (0, 0, 0))
+        toggle_label = self.render_label(toggle_text, (0, 0, 0))
         toggle_rect = toggle_label.get_rect()
         toggle_rect.bottomleft = (base_x, grid_rect.top - 5)
         self.screen.blit(toggle_label, toggle_rect)
@@ -203,17 +1253,17 @@ class DrawApp:
         border_colour = self.color
         bg_colour = self.fill_color or (0, 0, 0)
 
-        border_label = self.font.render('border colour', True, border_colour)
+        border_label = self.render_label('border colour', border_colour)
         border_rect = border_label.get_rect()
         border_rect.bottomleft = (base_x, toggle_rect.top - 5)
         self.screen.blit(border_label, border_rect)
 
-        bg_label = self.font.render('background colour', True, bg_colour)
+        bg_label = self.render_label('background colour', bg_colour)
         bg_rect = bg_label.get_rect()
         bg_rect.bottomleft = (base_x, border_rect.top - 5)
         self.screen.blit(bg_label, bg_rect)
 
-        canvas_label = self.font.render('canvas colour', True, (0, 0, 0))
+        canvas_label = self.render_label('canvas colour', (0, 0, 0))
         canvas_rect = canvas_label.get_rect()
         canvas_rect.bottomleft = (base_x, bg_rect.top - 5)
         self.screen.blit(canvas_label, canvas_rect)
@@ -229,11 +1279,11 @@ class DrawApp:
         circle_x = base_x - 2 * radius
         pygame.draw.circle(self.screen, (0, 0, 0), (circle_x, circle_y), radius)
 
-        self.border_label_rect = border_rect
-        self.background_label_rect = bg_rect
-        self.border_toggle_rect = toggle_rect
-        self.canvas_label_rect = canvas_rect
-        self.grid_toggle_rect = grid_rect
+        self.router.move_region('border_label', border_rect)
+        self.router.move_region('background_label', bg_rect)
+        self.router.move_region('border_toggle', toggle_rect)
+        self.router.move_region('canvas_label', canvas_rect)
+        self.router.move_region('grid_toggle', grid_rect)
 
     def draw_palette(self):
         ''' Draw the color palette (hue bar) at the bottom of the screen '''
@@ -255,47 +1305,57 @@ class DrawApp:
             x, y = self.sv_cursor_pos
             pygame.draw.circle(self.screen, (0, 0, 0), (x, y), 4, 1)
     
-    def draw_grid_lines(self):
-        ''' Draw gray grid lines that follow panning and zoom '''
+    def draw_grid_pattern(self, surface, x0, y0, width, height, spacing):
+        ''' Draw grid lines every spacing pixels across a width by height area starting at (x0, y0) '''
+        x = 0
+        while x < width:
+            pygame.draw.line(surface, self.grid_color, (x0 + int(x), y0), (x0 + int(x), y0 + height), 1)
+            x += spacing
+
+        y = 0
+        while y < height:
+            pygame.draw.line(surface, self.grid_color, (x0, y0 + int(y)), (x0 + width, y0 + int(y)), 1)
+            y += spacing
+
+    def build_grid_layer(self, spacing):
+        ''' Pre-render grid lines one spacing wider and taller than the window, transparent between lines '''
+        width, height = self.window_size
+        layer = pygame.Surface((int(width + spacing) + 1, int(height + spacing) + 1)).convert()
+        layer.fill(self.grid_key_color)
+        layer.set_colorkey(self.grid_key_color)
+        self.draw_grid_pattern(layer, 0, 0, layer.get_width(), layer.get_height(), spacing)
+        return layer
+
+    def draw_grid_lines(self, surface):
+        ''' Draw gray grid lines that follow panning and zoom, blitted from a cached layer '''
         if not self.show_grid:
             return
-        grid_color = (180, 180, 180)
 
         spacing = self.grid_spacing * self.zoom_level
         if spacing <= 0:
             return
+        # level of detail, keep only every few lines when they would crowd together (only with a custom grid_spacing,
+        # the default spacing is never under grid_min_spacing)
+        while spacing < self.grid_min_spacing:
+            spacing *= self.grid_major_every
 
+        x = int(self.grid_offset_x % spacing) - spacing
+        y = int(self.grid_offset_y % spacing) - spacing
         width, height = self.window_size
+        if spacing > self.grid_layer_max_spacing:
+            # only a handful of lines, and the layer would grow with the zoom, so draw them directly
+            self.draw_grid_pattern(surface, x, y, int(width + spacing) + 1, int(height + spacing) + 1, spacing)
+            return
 
-        first_x = (self.grid_offset_x % spacing) - spacing
-        x = first_x
-        while x < width:
-            pygame.draw.line(self.screen, grid_color, (int(x), 0), (int(x), height), 1)
-            x += spacing
-
-        first_y = (self.grid_offset_y % spacing) - spacing
-        y = first_y
-        while y < height:
-            pygame.draw.line(self.screen, grid_color, (0, int(y)), (width, int(y)), 1)
-            y += spacing
+        key = (spacing, self.window_size)
+        if key != self.grid_layer_key:
+            self.grid_layer = self.build_grid_layer(spacing)
+            self.grid_layer_key = key
+        surface.blit(self.grid_layer, (x, y))
     
     def draw_shape_labels(self):
         '''Draw small shape preview labels (triangle + rectangle + circle).'''
-        box_margin = 5
-        box_width = 35
-        box_height = 35
-
-        box_y = self.palette_rect.top - box_height - box_margin
-
-        first_x = box_margin
-        second_x = first_x + box_width + box_margin
-        third_x = second_x + box_width + box_margin
-
-        box_rects = [
-            pygame.Rect(first_x,  box_y, box_width, box_height),
-            pygame.Rect(second_x, box_y, box_width, box_height),
-            pygame.Rect(third_x,  box_y, box_width, box_height),
-        ]
+        box_rects = self.shape_box_rects
 
         for i, box_rect in enumerate(box_rects):
             if i == 0 and self.selected_shape == 'triangle':
@@ -355,151 +1415,246 @@ class DrawApp:
     def draw_mouse_position(self):
         x, y = pygame.mouse.get_pos()
         label = self.small_font.render(f"x: {x}, y: {y}", True, (0, 0, 0))
-        self.screen.blit(label, (5, 5))
+        self.screen.blit(label, (self.hud_rect.left + 5, self.hud_rect.top + 3))
     
     def draw_export_label(self):
-        font = getattr(self, "small_font", self.font)
-        label_surface = font.render("export", True, (0, 0, 0))
+        label_surface = self.render_label("export", (0, 0, 0), self.small_font)
         label_rect = label_surface.get_rect()
         label_rect.topright = (self.window_size[0] - 5, 5)
 
         self.screen.blit(label_surface, label_rect)
-        self.export_label_rect = label_rect
+        self.router.move_region('export', label_rect)
+
+    def view(self):
+        return (self.zoom_level, self.grid_offset_x, self.grid_offset_y)
+
+    def set_view(self, view):
+        self.zoom_level, self.grid_offset_x, self.grid_offset_y = view
 
     def handle_zoom(self, event):
-        ''' Zoom in and out with mouse wheel '''
-        if event.type == pygame.MOUSEWHEEL:
-            old_zoom = self.zoom_level
-            if event.y > 0:
-                self.zoom_level += 1
-            elif event.y < 0:
-                self.zoom_level -= 1
-                self.zoom_level = max(1, self.zoom_level)
-            
-            s = self.zoom_level / old_zoom
-            cx = self.window_size[0] / 2
-            cy = self.window_size[1] / 2
-
-            for shape in self.shapes:
-                points = shape[1]
-                for i, (px, py) in enumerate(points):
-                    points[i] = (cx + (px - cx) * s, cy + (py - cy) * s)
-
-            self.grid_offset_x = cx + (self.grid_offset_x - cx) * s
-            self.grid_offset_y = cy + (self.grid_offset_y - cy) * s
+        ''' Zoom in and out with mouse wheel, only the view transform changes '''
+        before = self.view()
+        old_zoom = self.zoom_level
+        self.zoom_level = max(1, self.zoom_level + event.y)
+
+        s = self.zoom_level / old_zoom
+        cx = self.window_size[0] / 2
+        cy = self.window_size[1] / 2
+
+        self.grid_offset_x = cx + (self.grid_offset_x - cx) * s
+        self.grid_offset_y = cy + (self.grid_offset_y - cy) * s
+        if self.view() != before:
+            self.history.record(('view', before, self.view()), 'zoom')
     
-    def handle_panning(self):
-        ''' Pan the view when left mouse button is held and mouse is moved '''
-        if pygame.mouse.get_pressed()[0]:
-            new_offset = pygame.mouse.get_pos()
-            x = new_offset[0] - self.start_offset[0]
-            y = new_offset[1] - self.start_offset[1]
-
-            for shape in self.shapes:
-                points = shape[1]
-                for i, (px, py) in enumerate(points):
-                    points[i] = (px + x, py + y)
-
-            self.grid_offset_x += x
-            self.grid_offset_y += y
-
-            self.start_offset = new_offset
+    def handle_panning(self, event):
+        ''' Pan the view while the left mouse button is held, only the view transform changes '''
+        if event.buttons[0]:
+            before = self.view()
+            self.grid_offset_x += event.rel[0]
+            self.grid_offset_y += event.rel[1]
+            self.history.record(('view', before, self.view()), 'pan')
+
+    def handle_canvas_click(self, event):
+        ''' Ctrl+click adds a point to the shape being drawn '''
+        if pygame.key.get_mods() & pygame.KMOD_CTRL:
+            self.handle_draw_shape(event)
+
+    def handle_quit(self, event):
+        self.running = False
+
+    def handle_expose(self, event):
+        ''' The window contents were lost, redraw everything next frame '''
+        self.frame_key = None
     
     def handle_line_thickness(self, event):
         ''' Change the line thickness with [ and ] keys '''
         if event.type == pygame.KEYDOWN:
             if event.key == pygame.K_LEFTBRACKET:
-                self.line_width -= 1
-                self.line_width = max(1, self.line_width)
+                self.set_setting('line_width', max(1, self.line_width - 1))
             elif event.key == pygame.K_RIGHTBRACKET:
-                self.line_width += 1
+                self.set_setting('line_width', self.line_width + 1)
     
+    def set_setting(self, name, value):
+        ''' Change a drawing setting such as a colour or the line width as an undoable edit '''
+        before = getattr(self, name)
+        if before != value:
+            setattr(self, name, value)
+            self.history.record(('set', name, before, value))
+
+    def undo_entry(self, entry):
+        ''' Reverse one history entry, returning what redo needs to re-apply it '''
+        kind = entry[0]
+        if kind == 'add':
+            shape_type, points, *style = self.pop_shape()
+            return ('add', shape_type, np.array(points, dtype=np.float64), tuple(style))
+        if kind == 'import':
+            shapes = [self.pop_shape() for _ in range(entry[1])][::-1]
+            points = np.concatenate([np.array(shape[1], dtype=np.float64) for shape in shapes])
+            counts = np.array([len(shape[1]) for shape in shapes])
+            return ('import', [(shape[0], tuple(shape[2:])) for shape in shapes], points, counts)
+        if kind == 'view':
+            self.set_view(entry[1])
+        elif kind == 'set':
+            setattr(self, entry[1], entry[2])
+        return entry
+
+    def redo_entry(self, entry):
+        ''' Re-apply one undone history entry, returning what undo needs to reverse it '''
+        kind = entry[0]
+        if kind == 'add':
+            self.add_shape(entry[1], entry[2], entry[3])
+            return ('add', None)
+        if kind == 'import':
+            for (shape_type, style), points in zip(entry[1], np.split(entry[2], np.cumsum(entry[3])[:-1])):
+                self.add_shape(shape_type, points, style)
+            return ('import', len(entry[1]))
+        if kind == 'view':
+            self.set_view(entry[2])
+        elif kind == 'set':
+            setattr(self, entry[1], entry[3])
+        return entry
+
     def handle_undo(self, event, mods):
-        ''' Undo last shape with Ctrl+Z '''
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_z and (mods & pygame.KMOD_CTRL):
-                if self.shapes:
-                    self.shapes.pop()
+        ''' Undo the last edit with Ctrl+Z, redo with Ctrl+Shift+Z or Ctrl+Y '''
+        if event.type == pygame.KEYDOWN and (mods & pygame.KMOD_CTRL):
+            if event.key == pygame.K_z and not (mods & pygame.KMOD_SHIFT):
+                self.history.undo(self.undo_entry)
+            elif event.key in (pygame.K_y, pygame.K_z):
+                self.history.redo(self.redo_entry)
     
-    def handle_color_pick(self, event):
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            if self.palette_rect.collidepoint(event.pos):
-                local_x = event.pos[0] - self.palette_rect.x
-                self.palette_cursor_x = event.pos[0]
-
-                self.current_hue = (local_x / (self.palette_width - 1)) * 360.0
-                self.build_sv_box()
+    def handle_save(self, event):
+        ''' Save the drawing in the background with Ctrl+S, asking for a path the first time '''
+        if event.key == pygame.K_s and (pygame.key.get_mods() & pygame.KMOD_CTRL):
+            self.save_document()
+
+    def save_document(self, filename=None):
+        ''' Write a compacted snapshot of the drawing on a background job, folding the journal back into it.
+        Returns the job, or None while another save is still running '''
+        if self.save_state is not None:
+            return None
+        # edits made while the snapshot is written are caught up in the journal afterwards
+        store, filename = self.shapes.copy(), filename or self.document_path
+        previous = (self.document_path, self.journal.file.tell()) if self.journal is not None else None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.save_state = {'count': len(store), 'low': len(store)}
+
+        def work(job):
+            path = filename or ask_path(
+                job, 'asksaveasfilename',
+                defaultextension=".tkd",
+                filetypes=[("Drawings", "*.tkd"), ("All files", "*.*")],
+                title="Save drawing as..."
+            )
+            if not path:
+                raise JobCancelled('save')
+            return path, store.save(path)
+
+        def done(result):
+            path, end = result
+            self.resume_journal(path, end)
+            print('Saved to:', path)
+
+        def failed(error):
+            if previous is not None:
+                self.resume_journal(*previous)
+            else:
+                self.save_state = None
+            if not isinstance(error, JobCancelled):
+                print('Save failed:', error)
+
+        return self.jobs.submit('save', work, done, failed)
+
+    def resume_journal(self, filename, end):
+        ''' Reopen the journal after a background save, writing the edits made while it ran '''
+        state, self.save_state = self.save_state, None
+        self.document_path = filename
+        self.journal = DocumentJournal(filename, end)
+        for _ in range(state['count'] - state['low']):
+            self.journal.write_pop()
+        for shape_id in range(state['low'], len(self.shapes)):
+            self.journal.write_add(self.shapes, shape_id)
+
+    def handle_job_keys(self, event):
+        ''' Ctrl+T traces an image in the background, Escape cancels running jobs '''
+        if event.key == pygame.K_t and (pygame.key.get_mods() & pygame.KMOD_CTRL):
+            self.start_trace()
+        elif event.key == pygame.K_ESCAPE:
+            self.jobs.cancel_all()
+
+    def start_trace(self, source=None):
+        ''' Trace an image to an SVG beside it on a background job and import it, asking for the image if none is given.
+        Returns the job, or None while another trace is still running '''
+        if self.jobs.running('trace'):
+            return None
+        quality = self.trace_quality
+
+        def work(job):
+            from trace import ImageTracer
+            path = source or ask_path(
+                job, 'askopenfilename',
+                filetypes=[("Images", "*.png *.jpg *.jpeg *.bmp *.gif *.webp"), ("All files", "*.*")],
+                title="Trace image..."
+            )
+            if not path:
+                raise JobCancelled('trace')
+            output = os.path.splitext(path)[0] + '.svg'
+            try:
+                ImageTracer().process_image(path, output, quality, workers=os.cpu_count(), progress=lambda done, total: job.report(done / total))
+            except JobCancelled:
+                if os.path.exists(output):
+                    os.remove(output)
+                raise
+            return output
+
+        def done(output):
+            print('Traced to:', output)
+            self.import_svg(output)
+
+        return self.jobs.submit('trace', work, done)
+
+    def set_picked_color(self, picked):
+        ''' Apply a picked colour to whichever colour the current mode edits '''
+        if self.color_mode == 'border':
+            self.set_setting('color', picked)
+        elif self.color_mode == 'background':
+            self.set_setting('fill_color', picked)
+        else:
+            self.set_setting('canvas_color', picked)
 
-                picked = self.palette_surface.get_at((local_x, event.pos[1] - self.palette_rect.y))
+    def handle_hue_pick(self, event):
+        ''' Pick a hue from the palette bar and rebuild the saturation/value box for it '''
+        local_x = event.pos[0] - self.palette_rect.x
+        self.palette_cursor_x = event.pos[0]
 
-                if self.color_mode == 'border':
-                    self.color = picked
-                elif self.color_mode == 'background':
-                    self.fill_color = picked
-                else:
-                    self.canvas_color = picked
+        self.current_hue = (local_x / (self.palette_width - 1)) * 360.0
+        self.build_sv_box()
 
-            elif self.sv_rect.collidepoint(event.pos):
-                local_x = event.pos[0] - self.sv_rect.x
-                local_y = event.pos[1] - self.sv_rect.y
-                picked = self.sv_surface.get_at((local_x, local_y))
+        self.set_picked_color(self.palette_surface.get_at((local_x, event.pos[1] - self.palette_rect.y)))
 
-                self.sv_cursor_pos = event.pos
+    def handle_sv_pick(self, event):
+        ''' Pick a colour from the saturation/value box '''
+        local_x = event.pos[0] - self.sv_rect.x
+        local_y = event.pos[1] - self.sv_rect.y
+        self.sv_cursor_pos = event.pos
+        self.set_picked_color(self.sv_surface.get_at((local_x, local_y)))
 
-                if self.color_mode == 'border':
-                    self.color = picked
-                elif self.color_mode == 'background':
-                    self.fill_color = picked
-                else:
-                    self.canvas_color = picked
-
-    def handle_color_mode_click(self, event):
-        ''' Switch color mode when labels are clicked '''
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            if self.border_label_rect.collidepoint(event.pos):
-                self.color_mode = 'border'
-            elif self.background_label_rect.collidepoint(event.pos):
-                self.color_mode = 'background'
-            elif self.canvas_label_rect.collidepoint(event.pos):
-                self.color_mode = 'canvas'
+    def set_color_mode(self, mode):
+        ''' Switch which colour the palette edits when a colour label is clicked '''
+        self.color_mode = mode
 
     def handle_border_toggle_click(self, event):
         ''' Toggle border visibility when label is clicked '''
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            if self.border_toggle_rect.collidepoint(event.pos):
-                self.show_border = not self.show_border
+        self.set_setting('show_border', not self.show_border)
     
-    def handle_shape_selection(self, event):
-        '''Set selected_shape based on which shape label box was clicked.'''
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            box_margin = 5
-            box_width = 35
-            box_height = 35
-
-            box_y = self.palette_rect.top - box_height - box_margin
-
-            first_x = box_margin
-            second_x = first_x + box_width + box_margin
-            third_x = second_x + box_width + box_margin
-
-            triangle_rect = pygame.Rect(first_x,  box_y, box_width, box_height)
-            rectangle_rect = pygame.Rect(second_x, box_y, box_width, box_height)
-            circle_rect = pygame.Rect(third_x,  box_y, box_width, box_height)
-
-            mx, my = event.pos
-
-            if triangle_rect.collidepoint(mx, my):
-                self.selected_shape = 'triangle'
-            elif rectangle_rect.collidepoint(mx, my):
-                self.selected_shape = 'rectangle'
-            elif circle_rect.collidepoint(mx, my):
-                self.selected_shape = 'circle'
+    def select_shape(self, shape_type):
+        '''Set selected_shape when its label box is clicked.'''
+        self.selected_shape = shape_type
     
     def handle_grid_toggle_click(self, event):
         ''' Toggle grid visibility when label is clicked '''
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            if self.grid_toggle_rect.collidepoint(event.pos):
-                self.show_grid = not self.show_grid
+        self.set_setting('show_grid', not self.show_grid)
     
     def color_to_hex(self, c):
         if c is None:
@@ -507,102 +1662,244 @@ class DrawApp:
         r, g, b = int(c[0]), int(c[1]), int(c[2])
         return f"#{r:02x}{g:02x}{b:02x}"
     
+    def write_tk_script(self, file_path, mode=None, store=None, view=None, job=None, canvas=None):
+        ''' Write the drawing, as seen in the current view, out as a tkinter script, canvas being (size, colour) '''
+        store = self.shapes if store is None else store
+        view = view or self.view()
+        canvas = canvas or (self.window_size, self.canvas_color)
+        # paths export as polygons flattened for the exported view's zoom, like they are drawn
+        store = store.flattened(self.path_tolerance / (1 << min(view[0].bit_length() - 1, self.path_max_level)))
+        mode = mode or self.export_mode
+        if mode == 'auto':
+            mode = 'packed' if len(store) > self.export_packed_threshold else 'lines'
+        try:
+            with open(file_path, "w", encoding="utf-8") as file:
+                if mode == 'packed':
+                    self.write_tk_packed(file, store, view, canvas, job)
+                else:
+                    self.write_tk_lines(file, store, view, canvas, job)
+        except JobCancelled:
+            os.remove(file_path)
+            raise
+
+    def write_tk_canvas(self, file, canvas):
+        (width, height), color = canvas
+        file.write('root = tk.Tk()\n')
+        file.write('root.title("Tkinter Canvas")\n')
+        file.write(f'canvas = tk.Canvas(root, width={width}, height={height}, bg="{self.color_to_hex(color)}")\n')
+        file.write('canvas.pack()\n\n')
+
+    def tk_number(self, v):
+        ''' Format an exported coordinate at full precision, whole values as ints '''
+        if v % 1 == 0:
+            return str(int(v))
+        return repr(v)
+
+    def write_tk_lines(self, file, store, view, canvas, job=None):
+        ''' Stream one readable canvas.create_* call per shape '''
+        file.write('import tkinter as tk\n')
+        self.write_tk_canvas(file, canvas)
+        zoom, ox, oy = view
+        separator = ''
+        for i, shape in enumerate(store):
+            if job is not None and i % 1024 == 0:
+                job.report(i / len(store))
+            shape_type, points, border_color, line_width, fill_color, show_border = shape
+            points = (points * zoom + (ox, oy)).tolist()
+            outline = self.color_to_hex(border_color) if show_border and line_width > 0 else ""
+            fill = self.color_to_hex(fill_color) if fill_color is not None else ""
+            width = line_width if show_border else 0
+
+            if shape_type == 'rectangle':
+                xs = [p[0] for p in points]
+                ys = [p[1] for p in points]
+                x0, y0 = min(xs), min(ys)
+                x1, y1 = max(xs), max(ys)
+                coords = ', '.join(map(self.tk_number, (x0, y0, x1, y1)))
+                line = f'canvas.create_rectangle({coords}, outline="{outline}", fill="{fill}", width={width})'
+
+            elif shape_type == 'circle':
+                xs = [p[0] for p in points]
+                ys = [p[1] for p in points]
+                x0, y0 = min(xs), min(ys)
+                x1, y1 = max(xs), max(ys)
+                coords = ', '.join(map(self.tk_number, (x0, y0, x1, y1)))
+                line = f'canvas.create_oval({coords}, outline="{outline}", fill="{fill}", width={width})'
+
+            elif shape_type == 'triangle':
+                (x1, y1), (x2, y2), (x3, y3) = points
+                coords = ', '.join(map(self.tk_number, (x1, y1, x2, y2, x3, y3)))
+                line = f'canvas.create_polygon({coords}, outline="{outline}", fill="{fill}", width={width})'
+
+            elif shape_type == 'path':
+                coords = ', '.join(self.tk_number(v) for point in points for v in point)
+                line = f'canvas.create_polygon({coords}, outline="{outline}", fill="{fill}", width={width})'
+
+            else:
+                continue
+            file.write(separator + line)
+            separator = '\n'
+
+        file.write('\n\nroot.mainloop()\n')
+
+    def write_tk_packed(self, file, store, view, canvas, job=None, batch=2000):
+        ''' Stream the shapes as packed style, shape and coordinate tables plus a loop creating items in batches '''
+        n = store.count
+        counts = np.diff(store.offsets[:n + 1])
+        starts = store.offsets[:n]
+        screen = store.transformed(*view).astype(np.float32)
+
+        # rectangles and circles export as their bounding box, everything else as a polygon
+        kind_codes = np.array([self.tk_kinds.get(name, 0) for name in store.type_names], dtype=np.uint32)
+        kinds = kind_codes[store.types[:n]]
+        is_box = kinds != 0
+        sizes = np.where(is_box, 4, 2 * counts)
+        out_starts = np.cumsum(sizes) - sizes
+        coords = np.empty(int(sizes.sum()), dtype=np.float32)
+        if n:
+            lo = np.minimum.reduceat(screen, starts)[is_box]
+            hi = np.maximum.reduceat(screen, starts)[is_box]
+            coords[out_starts[is_box][:, None] + np.arange(4)] = np.hstack((lo, hi))
+            owner = np.repeat(np.arange(n), counts)
+            polygon = ~is_box[owner]
+            owner = owner[polygon]
+            position = out_starts[owner] + 2 * (np.flatnonzero(polygon) - starts[owner])
+            coords[position] = screen[polygon, 0]
+            coords[position + 1] = screen[polygon, 1]
+
+        # one style per distinct (outline, fill, width), colours packed as 24-bit ints for a fast unique
+        shown = store.show_borders[:n]
+        widths = np.where(shown, store.line_widths[:n], 0).astype(np.int64)
+        outline = np.where(shown & (widths > 0), store.border_colors[:n].astype(np.int64) @ [1 << 16, 1 << 8, 1], -1)
+        fill = np.where(store.has_fill[:n], store.fill_colors[:n].astype(np.int64) @ [1 << 16, 1 << 8, 1], -1)
+        _, color_index = np.unique((outline + 1) << 25 | (fill + 1), return_inverse=True)
+        _, first, style_index = np.unique(color_index.reshape(-1) * (int(widths.max(initial=0)) + 1) + widths, return_index=True, return_inverse=True)
+        table = np.column_stack((kinds, style_index.reshape(-1), sizes)).astype(np.uint32)
+        if job is not None:
+            job.report(0.5)
+
+        file.write('import sys\nimport tkinter as tk\nfrom array import array\nfrom base64 import b64decode\n')
+        self.write_tk_canvas(file, canvas)
+        file.write('# (outline, fill, width)\nSTYLES = [\n')
+        for border, background, width in zip(outline[first].tolist(), fill[first].tolist(), widths[first].tolist()):
+            border = f'#{border:06x}' if border >= 0 else ''
+            background = f'#{background:06x}' if background >= 0 else ''
+            file.write(f'    ("{border}", "{background}", {width}),\n')
+        file.write(']\n# kind (0 polygon, 1 rectangle, 2 oval), style, number of coordinates\n')
+        self.write_packed_array(file, 'SHAPES', 'I', table)
+        self.write_packed_array(file, 'COORDS', 'f', coords)
+        file.write(f'''if sys.byteorder == 'big':
+    SHAPES.byteswap()
+    COORDS.byteswap()
+
+BATCH = {batch}
+create = (canvas.create_polygon, canvas.create_rectangle, canvas.create_oval)
+
+def draw(shape, coord):
+    end = min(shape + 3 * BATCH, len(SHAPES))
+    while shape < end:
+        kind, style, n = SHAPES[shape:shape + 3]
+        outline, fill, width = STYLES[style]
+        create[kind](*COORDS[coord:coord + n], outline=outline, fill=fill, width=width)
+        shape += 3
+        coord += n
+    if shape < len(SHAPES):
+        root.after(1, draw, shape, coord)
+
+draw(0, 0)
+root.mainloop()
+''')
+
+    def write_packed_array(self, file, name, typecode, values, chunk=3 << 10):
+        ''' Write an array as little-endian base64, streamed a line at a time '''
+        data = np.ascontiguousarray(values, dtype=np.dtype(typecode).newbyteorder('<')).tobytes()
+        file.write(f"{name} = array('{typecode}', b64decode(\n")
+        for i in range(0, len(data), chunk):
+            file.write(f"    b'{base64.b64encode(data[i:i + chunk]).decode()}'\n")
+        if not data:
+            file.write("    b''\n")
+        file.write('))\n')
+
     def handle_export_click(self, event):
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            if self.export_label_rect.collidepoint(event.pos):
-                print("clicked")
-
-                lines = []
-                for shape in self.shapes:
-                    shape_type, points, border_color, line_width, fill_color, show_border = shape
-                    outline = self.color_to_hex(border_color) if show_border and line_width > 0 else ""
-                    fill = self.color_to_hex(fill_color) if fill_color is not None else ""
-                    width = line_width if show_border else 0
-
-                    if shape_type == 'rectangle':
-                        xs = [p[0] for p in points]
-                        ys = [p[1] for p in points]
-                        x0, y0 = min(xs), min(ys)
-                        x1, y1 = max(xs), max(ys)
-                        line = f'canvas.create_rectangle({x0}, {y0}, {x1}, {y1}, outline="{outline}", fill="{fill}", width={width})'
-                        lines.append(line)
-
-                    elif shape_type == 'circle':
-                        xs = [p[0] for p in points]
-                        ys = [p[1] for p in points]
-                        x0, y0 = min(xs), min(ys)
-                        x1, y1 = max(xs), max(ys)
-                        line = f'canvas.create_oval({x0}, {y0}, {x1}, {y1}, outline="{outline}", fill="{fill}", width={width})'
-                        lines.append(line)
-
-                    elif shape_type == 'triangle':
-                        (x1, y1), (x2, y2), (x3, y3) = points
-                        line = f'canvas.create_polygon({x1}, {y1}, {x2}, {y2}, {x3}, {y3}, outline="{outline}", fill="{fill}", width={width})'
-                        lines.append(line)
-
-                # open file dialog
-                root = tk.Tk()
-                root.withdraw()
-                file_path = filedialog.asksaveasfilename(
-                    defaultextension=".py",
-                    filetypes=[("Python files", "*.py"), ("All files", "*.*")],
-                    title="Export script as..."
-                )
-
-                root.destroy()
-                if file_path:
-                    with open(file_path, "w", encoding="utf-8") as file:
-                        file.write('import tkinter as tk\n')
-                        file.write('root = tk.Tk()\n')
-                        file.write('root.title("Tkinter Canvas")\n')
-                        file.write(f'canvas = tk.Canvas(root, width={self.window_size[0]}, height={self.window_size[1]}, bg="{self.color_to_hex(self.canvas_color)}")\n')
-                        file.write('canvas.pack()\n\n')
-                        file.write("\n".join(lines))
-                        file.write('\n\nroot.mainloop()\n')
-                    print("Exported to:", file_path)
+        ''' Export the drawing as a tkinter script on a background job when the export label is clicked '''
+        print("clicked")
+        if self.jobs.running('export'):
+            return
+        # snapshot everything the script depends on, the worker must not read the live app
+        store, view, canvas = self.shapes.copy(), self.view(), (self.window_size, self.canvas_color)
+
+        def work(job):
+            file_path = ask_path(
+                job, 'asksaveasfilename',
+                defaultextension=".py",
+                filetypes=[("Python files", "*.py"), ("All files", "*.*")],
+                title="Export script as..."
+            )
+            if file_path:
+                self.write_tk_script(file_path, store=store, view=view, job=job, canvas=canvas)
+            return file_path
+
+        self.jobs.submit('export', work, lambda file_path: file_path and print("Exported to:", file_path))
     
     def main(self):
-        running = True
-        while running:
-            self.handle_panning()
-            for event in pygame.event.get():
-                mods = pygame.key.get_mods()
-
-                if event.type == pygame.QUIT:
-                    running = False
-
-                self.handle_color_mode_click(event)
-                self.handle_color_pick(event)
-                self.handle_border_toggle_click(event)
-                self.handle_grid_toggle_click(event)
-                self.handle_shape_selection(event)
-                self.handle_export_click(event)
-
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    if mods & pygame.KMOD_CTRL:
-                        self.handle_draw_shape(event)
-                    
-                    self.start_offset = pygame.mouse.get_pos()
-                
-                self.handle_line_thickness(event)
-                self.handle_undo(event, mods)
-                self.handle_zoom(event)
-
-            self.screen.fill(self.canvas_color)
-            self.draw_grid_lines()
-            self.draw_shapes()
-            self.draw_sv_box()
-            self.draw_labels()
-            self.draw_palette()
-            self.draw_export_label()
-            self.draw_shape_labels()
-            self.draw_cursor()
-            
-            pygame.display.flip()
-
+        while self.running:
+            events = pygame.event.get()
+            if not events:
+                # nothing to do, sleep until the next event instead of spinning, waking often enough to show job progress
+                event = pygame.event.wait(100 if self.jobs.jobs else self.idle_timeout)
+                if event.type != pygame.NOEVENT:
+                    events.append(event)
+
+            self.profiler.begin_frame()
+            with self.profiler.stage('events'):
+                self.router.dispatch(events)
+                self.jobs.drain()
+                self.expire_selection()
+            self.draw_frame()
+            self.profiler.end_frame(shape_count=len(self.shapes), vertex_count=self.shapes.vertex_count, visible_count=self.visible_count)
+            self.clock.tick(self.max_fps)
+
+        self.jobs.shutdown()
+        self.jobs.drain()
+        self.profiler.stop_recording()
         pygame.quit()
         sys.exit()
 
 if __name__ == '__main__':
-    app = DrawApp()
-    app.main()
+    parser = argparse.ArgumentParser(description='Draw vector shapes and export them as tkinter code')
+    parser.add_argument('document', nargs='?', help='drawing to open (.tkd), an empty one is created at this path if missing and edits are journalled to it')
+    parser.add_argument('--render', metavar='PNG', help='rasterize the document to a PNG without opening a window')
+    parser.add_argument('--size', type=int, nargs=2, default=(800, 600), metavar=('W', 'H'), help='window or render size')
+    parser.add_argument('--fit', action='store_true', help='fit the whole drawing in the render')
+    parser.add_argument('--ui', action='store_true', help='include the tool UI in the render')
+    parser.add_argument('--trace', metavar='FILE', help='record per-frame timings to a .csv or JSON lines file')
+    parser.add_argument('--import', dest='svg', metavar='SVG', help='add the paths of a traced SVG (trace.py output) to the drawing')
+    args = parser.parse_args()
+
+    if args.render:
+        if not args.svg and (not args.document or not os.path.exists(args.document)):
+            parser.error('--render needs an existing document or --import')
+        app = DrawApp(window_size=args.size, headless=True)
+        if args.document:
+            app.open_document(args.document, journal=False)
+        if args.svg:
+            try:
+                app.import_svg(args.svg)
+            except ValueError as e:
+                parser.error(str(e))
+        if args.fit:
+            app.fit_view()
+        app.render_png(args.render, args.ui)
+        pygame.quit()
+    else:
+        app = DrawApp(window_size=args.size)
+        if args.document:
+            app.open_document(args.document)
+        if args.svg:
+            try:
+                app.import_svg(args.svg)
+            except ValueError as e:
+                parser.error(str(e))
+        if args.trace:
+            app.profiler.start_recording(args.trace)
+        app.main()
@@ -1,5 +1,133 @@
-from PIL import Image
+import argparse, glob, gzip, hashlib, json, math, os, re, shutil, subprocess, sys, time
+from PIL import Image, ImageDraw, ImageSequence
 from potrace import Bitmap
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+# never fork worker pools: tracing also runs on a thread of the pygame app, and forking a threaded process is unsafe
+_pool_context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+_maxrss_scale = 1 if sys.platform == 'darwin' else 1024
+
+def _peak_rss():
+    ''' Peak resident memory of this process in bytes, 0 where it cannot be read '''
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _maxrss_scale
+
+class MaskEngine:
+    ''' Quantized index buffer with per-colour pixel counts and bulk mask generation '''
+    def __init__(self, q):
+        self.width, self.height = q.size
+        self.indices = np.frombuffer(q.tobytes(), dtype=np.uint8).reshape(self.height, self.width)
+        flat = self.indices.ravel()
+        self.counts = np.bincount(flat, minlength=256)
+
+        # pixel positions grouped by palette index, so each colour is a contiguous slice
+        self.order = np.argsort(flat, kind='stable')
+        self.offsets = np.zeros(257, dtype=np.int64)
+        np.cumsum(self.counts, out=self.offsets[1:])
+
+    def used_indices(self, min_pixels=1):
+        ''' Return the palette indices covering at least min_pixels pixels '''
+        return [int(i) for i in np.flatnonzero(self.counts >= max(1, min_pixels))]
+
+    def positions(self, idx):
+        ''' Flat pixel positions of the given palette index (a view, no copy) '''
+        return self.order[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def iter_masks(self, indices):
+        ''' Yield (idx, mask) pairs reusing one buffer, each mask is only valid until the next one '''
+        buffer = np.ones(self.width * self.height, dtype=bool)
+        view = buffer.reshape(self.height, self.width)
+        for idx in indices:
+            pos = self.positions(idx)
+            buffer[pos] = False
+            yield idx, view
+            buffer[pos] = True
+
+class TraceProfile:
+    ''' Per-stage wall and CPU times, per-colour trace timings and output counts for one tracing run.
+    Pool workers' CPU time is added to the stage that waited on them, peak_rss is the parent process only and
+    worker_peak_rss the largest worker '''
+    stage_order = ('load', 'downscale', 'quantize', 'masks', 'trace', 'serialize', 'write')
+
+    def __init__(self, **info):
+        self.info = info
+        self.stages = {}
+        self.colors = []
+        self.paths = 0
+        self.segments = 0
+        self.peak_rss = 0
+        self.worker_peak_rss = 0
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name):
+        ''' Time a stage exclusively, the enclosing stage is paused while a nested one runs '''
+        self._pause()
+        self._stack.append([name, time.perf_counter(), time.process_time()])
+        try:
+            yield
+        finally:
+            self._pause()
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1:] = time.perf_counter(), time.process_time()
+            self.peak_rss = max(self.peak_rss, _peak_rss())
+
+    def _pause(self):
+        ''' Charge the time since the innermost stage last resumed to that stage '''
+        if not self._stack:
+            return
+        name, wall, cpu = self._stack[-1]
+        now_wall, now_cpu = time.perf_counter(), time.process_time()
+        totals = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+        totals['wall'] += now_wall - wall
+        totals['cpu'] += now_cpu - cpu
+        self._stack[-1][1:] = now_wall, now_cpu
+
+    def add_color(self, idx, fill, pixels, seconds, cpu, paths, segments):
+        ''' Record the tracing cost and output size of one palette colour '''
+        self.colors.append({'index': idx, 'fill': fill, 'pixels': pixels, 'wall': seconds, 'cpu': cpu, 'paths': paths, 'segments': segments})
+        self.paths += paths
+        self.segments += segments
+
+    def add_worker(self, name, cpu, peak_rss):
+        ''' Charge CPU time spent in a pool worker to a stage and track the workers' peak memory '''
+        self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})['cpu'] += cpu
+        self.worker_peak_rss = max(self.worker_peak_rss, peak_rss)
+
+    def to_dict(self):
+        ''' Return the profile as plain JSON-serializable data '''
+        order = {name: i for i, name in enumerate(self.stage_order)}
+        return {
+            **self.info,
+            'stages': dict(sorted(self.stages.items(), key=lambda item: order.get(item[0], len(order)))),
+            'wall': sum(s['wall'] for s in self.stages.values()),
+            'cpu': sum(s['cpu'] for s in self.stages.values()),
+            'paths': self.paths,
+            'segments': self.segments,
+            'peak_rss': self.peak_rss,
+            'worker_peak_rss': self.worker_peak_rss,
+            'colors': self.colors,
+        }
+
+    def write_jsonl(self, filename):
+        ''' Append the profile as one JSON line '''
+        with open(filename, 'a') as file:
+            file.write(json.dumps(self.to_dict()) + '\n')
 
 class ImageTracer:
     def __init__(self):
@@ -16,6 +144,10 @@ class ImageTracer:
             1.0: (96,  25,  2, 0.60, 0.15, 1.00, 4),
         }
         self.opticurve = True
+        self.compact = False
+        self.quantizer = 'mediancut'
+        self.palette = None
+        self._fraction_table = {}
         self.configure_quality(0.5)
 
     def configure_quality(self, level):
@@ -28,7 +160,17 @@ class ImageTracer:
         self.opttolerance = opttolerance
         self.downscale = downscale
         self.decimals = decimals
+        self.quality = level
     
+    def settings(self):
+        ''' Return the quality level and options needed to rebuild this tracer in another process '''
+        return self.quality, self.opticurve, self.compact, self.quantizer, self.palette
+
+    def apply_settings(self, settings):
+        ''' Restore a tracer from the tuple returned by settings '''
+        quality, self.opticurve, self.compact, self.quantizer, self.palette = settings
+        self.configure_quality(quality)
+
     def rv(self, v):
         ''' Round the value to the specified number of decimals '''
         v = round(v, self.decimals)
@@ -41,16 +183,83 @@ class ImageTracer:
         bm = Bitmap(mask, blacklevel=0.5)
         return bm.trace(turdsize=self.turdsize, alphamax=self.alphamax, opticurve=self.opticurve, opttolerance=self.opttolerance)
 
-    def mask_for_index(self, idx, indices, w, h):
-        ''' Create a binary mask for the given palette index '''
-        mask_data = [0 if p == idx else 255 for p in indices]
-        mask = Image.new('L', (w, h), 255)
-        mask.putdata(mask_data)
-        return mask
+    def compact_numbers(self, values):
+        ''' Format coordinates scaled by 10**decimals, each prefixed by the separator it needs '''
+        table = self._fraction_table.get(self.decimals)
+        if table is None:
+            table = [('.' + str(f).rjust(self.decimals, '0')).rstrip('0').rstrip('.') for f in range(10 ** self.decimals)]
+            self._fraction_table[self.decimals] = table
+
+        whole, frac = np.divmod(np.abs(values), 10 ** self.decimals)
+        # a space is only needed when the number starts with a digit, or a bare fraction follows another fraction
+        after_fraction = np.zeros(len(values), dtype=bool)
+        after_fraction[1:] = frac[:-1] != 0
+        prefix = np.where(values < 0, 2, np.where((values > 0) & (whole == 0) & after_fraction, 0, 1))
+        return [
+            ('', ' ', '-')[p] + ((str(w) if w else '') + table[f] or '0')
+            for p, w, f in zip(prefix.tolist(), whole.tolist(), frac.tolist())
+        ]
+
+    def compact_paths(self, plist):
+        ''' Serialize curves as relative path data with repeated commands and separators elided '''
+        commands = []
+        points = []
+        refs = []
+        for curve in plist:
+            current = len(points)
+            points.append(curve.start_point)
+            refs.append(current)
+            curve_commands = []
+            for segment in curve.segments:
+                if segment.is_corner:
+                    curve_commands.append('l')
+                    points.append(segment.c)
+                    points.append(segment.end_point)
+                    refs.extend((current, current + 1))
+                    current += 2
+                else:
+                    curve_commands.append('c')
+                    points.extend((segment.c1, segment.c2, segment.end_point))
+                    refs.extend((current, current, current))
+                    current += 3
+            commands.append(curve_commands)
+        if not points:
+            return
+
+        # round absolute coordinates first so the relative offsets add back up without drift,
+        # start points reference themselves and stay absolute
+        scaled = np.rint(np.array([(p.x, p.y) for p in points]) * 10 ** self.decimals).astype(np.int64)
+        scaled -= scaled[refs] * (np.arange(len(points)) != refs)[:, None]
+        numbers = self.compact_numbers(scaled.ravel())
+
+        pos = 0
+        for curve_commands in commands:
+            parts = ['M', numbers[pos].lstrip(), numbers[pos + 1]]
+            pos += 2
+            last_command = None
+            for command in curve_commands:
+                count = 4 if command == 'l' else 6
+                if command != last_command:
+                    # the command letter already separates its first number
+                    parts.append(command)
+                    parts.append(numbers[pos].lstrip())
+                    parts.extend(numbers[pos + 1:pos + count])
+                    last_command = command
+                else:
+                    parts.extend(numbers[pos:pos + count])
+                pos += count
+            parts.append('z')
+            yield ''.join(parts)
+
+    def iter_svg(self, plist, fill):
+        ''' Yield SVG path elements for the traced paths one at a time '''
+        if self.compact:
+            r, g, b = (int(v) for v in fill[4:-1].split(','))
+            fill = f'#{r:02x}{g:02x}{b:02x}'
+            for d in self.compact_paths(plist):
+                yield f"<path d='{d}' fill='{fill}'/>"
+            return
 
-    def build_svg(self, plist, fill):
-        ''' Build SVG path elements from the traced paths '''
-        svg_paths = []
         for curve in plist:
             parts = []
             fs = curve.start_point
@@ -68,51 +277,731 @@ class ImageTracer:
 
             parts.append('Z')
             d = ''.join(parts)
-            svg_paths.append(f"<path d='{d}' fill='{fill}' stroke='none'/>")
-        
-        return svg_paths
+            yield f"<path d='{d}' fill='{fill}' stroke='none'/>"
 
-    def process_image(self, input_filename, output_filename, quality=0.5):
-        ''' Process the input image and save the traced SVG output '''
-        self.configure_quality(quality)
-        img = Image.open(input_filename).convert('RGB')
+    def build_svg(self, plist, fill):
+        ''' Build SVG path elements from the traced paths '''
+        return list(self.iter_svg(plist, fill))
+
+    def write_svg(self, output_filename, w, h, paths, buffer_size=1 << 16):
+        ''' Stream SVG path elements to disk, gzip compressed when writing a .svgz file '''
+        if os.fspath(output_filename).endswith('.svgz'):
+            file = gzip.open(output_filename, 'wt')
+        else:
+            file = open(output_filename, 'w', buffering=buffer_size)
+
+        with file:
+            file.write(f"<svg xmlns='http://www.w3.org/2000/svg' width='{w}' height='{h}' viewBox='0 0 {w} {h}'>\n")
+            for path in paths:
+                file.write(f'  {path}\n')
+            file.write('</svg>\n')
+
+    def color_jobs(self, q, masks, keep=None):
+        ''' Return (palette index, fill) pairs for every colour worth tracing, in palette order, or for the colours
+        in keep present at all when the min_pixels decision was already made for the whole image '''
+        palette = q.getpalette()
+        jobs = []
+        used = masks.used_indices(self.min_pixels) if keep is None else [idx for idx in masks.used_indices() if idx in keep]
+        for idx in used:
+            r, g, b = palette[3*idx:3*idx+3]
+            jobs.append((idx, f'rgb({r},{g},{b})'))
+        return jobs
+
+    def trace_counted(self, mask):
+        ''' Trace one colour mask, returning the paths with (seconds, cpu seconds, path count, segment count) '''
+        start, start_cpu = time.perf_counter(), time.process_time()
+        plist = self.trace_image(mask)
+        seconds, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+        return plist, (seconds, cpu, len(plist), sum(len(curve.segments) for curve in plist))
+
+    def trace_colors(self, q, workers=1, profile=None, progress=None, keep=None):
+        ''' Yield SVG path elements for every used palette colour, serially or across a process pool, calling progress(done, total) per colour '''
+        profile = profile or TraceProfile()
+        with profile.stage('masks'):
+            masks = MaskEngine(q)
+            jobs = self.color_jobs(q, masks, keep)
+        fills = dict(jobs)
+
+        if workers <= 1 or len(jobs) <= 1:
+            indices = [idx for idx, fill in jobs]
+            mask_iter = masks.iter_masks(indices)
+            for idx in indices:
+                with profile.stage('masks'):
+                    _, mask = next(mask_iter)
+                with profile.stage('trace'):
+                    plist, stats = self.trace_counted(mask)
+                with profile.stage('serialize'):
+                    paths = list(self.iter_svg(plist, fills[idx]))
+                profile.add_color(idx, fills[idx], int(masks.counts[idx]), *stats)
+                del plist
+                yield from paths
+                if progress is not None:
+                    progress(len(profile.colors), len(jobs))
+            return
+
+        # workers read the index buffer from shared memory and build their own masks
+        shm = shared_memory.SharedMemory(create=True, size=masks.indices.nbytes)
+        try:
+            np.ndarray(masks.indices.shape, dtype=np.uint8, buffer=shm.buf)[:] = masks.indices
+            init_args = (shm.name, masks.indices.shape, self.settings())
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context, initializer=_init_worker, initargs=init_args)
+            try:
+                # keep a bounded window of colours in flight so finished paths never pile up ahead of the consumer
+                pending = deque()
+                queued = iter(jobs)
+                for idx, fill in jobs:
+                    for job in queued:
+                        pending.append(pool.submit(_trace_job, job))
+                        if len(pending) >= 2 * workers:
+                            break
+                    with profile.stage('trace'):
+                        paths, stats, worker_rss = pending.popleft().result()
+                    profile.add_worker('trace', stats[1], worker_rss)
+                    profile.add_color(idx, fill, int(masks.counts[idx]), *stats)
+                    yield from paths
+                    if progress is not None:
+                        progress(len(profile.colors), len(jobs))
+            finally:
+                # a consumer that stops early, e.g. a cancelled job, should not wait for queued colours
+                pool.shutdown(cancel_futures=True)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def load_image(self, input_filename):
+        ''' Load the input image as RGB and apply the preset downscale '''
+        return self.downscale_image(Image.open(input_filename).convert('RGB'))
+
+    def downscale_image(self, img):
+        ''' Resize the image by the preset downscale factor '''
         if self.downscale != 1.0:
             new_w = max(1, int(img.width * self.downscale))
             new_h = max(1, int(img.height * self.downscale))
             img = img.resize((new_w, new_h), Image.LANCZOS)
+        return img
+
+    quantizers = ('mediancut', 'octree', 'kmeans')
+
+    def quantize(self, img):
+        ''' Palette-quantize the image to n_colors, or map it onto the fixed palette when one is set '''
+        if self.palette is not None:
+            return img.quantize(palette=self.palette_image(self.palette), dither=Image.Dither.NONE)
+        if self.quantizer == 'mediancut':
+            return img.convert('P', palette=Image.ADAPTIVE, colors=self.n_colors)
+        if self.quantizer == 'octree':
+            return img.quantize(self.n_colors, method=Image.Quantize.FASTOCTREE)
+        if self.quantizer == 'kmeans':
+            return img.quantize(palette=self.palette_image(self.kmeans_palette(img)), dither=Image.Dither.NONE)
+        raise ValueError(f'unknown quantizer {self.quantizer!r}, expected one of {self.quantizers}')
+
+    def palette_image(self, colors):
+        ''' Return a palette image holding exactly the given RGB colours '''
+        if not 0 < len(colors) <= 256:
+            raise ValueError(f'a palette needs 1 to 256 colours, got {len(colors)}')
+        img = Image.new('P', (1, 1))
+        img.putpalette([v for color in colors for v in color])
+        return img
+
+    def kmeans_palette(self, img, sample=20000, iterations=8, seed=0):
+        ''' Refine a median-cut palette of a random pixel sample with a few k-means iterations '''
+        pixels = np.asarray(img).reshape(-1, 3)
+        if len(pixels) > sample:
+            pixels = pixels[np.random.default_rng(seed).choice(len(pixels), sample, replace=False)]
+
+        start = Image.fromarray(pixels.reshape(1, -1, 3)).convert('P', palette=Image.ADAPTIVE, colors=self.n_colors)
+        centers = np.array(start.getpalette(), dtype=np.float64).reshape(-1, 3)
+        pixels = pixels.astype(np.float64)
+        norms = (pixels ** 2).sum(axis=1)
+        for _ in range(iterations):
+            distances = norms[:, None] - 2 * pixels @ centers.T + (centers ** 2).sum(axis=1)
+            labels = distances.argmin(axis=1)
+            counts = np.bincount(labels, minlength=len(centers))
+            used = counts > 0
+            for c in range(3):
+                sums = np.bincount(labels, weights=pixels[:, c], minlength=len(centers))
+                centers[used, c] = sums[used] / counts[used]
+        return tuple(tuple(int(v) for v in np.rint(center)) for center in centers)
 
-        q = img.convert('P', palette=Image.ADAPTIVE, colors=self.n_colors)
+    def load_palette(self, filename):
+        ''' Read a fixed palette from a JSON list of [r, g, b] or '#rrggbb' colours, or build one from an image '''
+        if os.fspath(filename).endswith('.json'):
+            with open(filename) as file:
+                colors = json.load(file)
+            return tuple(tuple(bytes.fromhex(c.lstrip('#'))) if isinstance(c, str) else tuple(c) for c in colors)
+
+        return self.load_palette_from(self.load_image(filename))
+
+    def load_palette_from(self, img):
+        ''' Build a fixed palette from the image with the configured quantizer '''
+        palette = self.quantize(img).getpalette()
+        return tuple(tuple(palette[3*i:3*i+3]) for i in range(len(palette) // 3))
+
+    def process_image(self, input_filename, output_filename, quality=0.5, workers=1, progress=None):
+        ''' Process the input image and save the traced SVG output, returning a TraceProfile of the run '''
+        self.configure_quality(quality)
+        profile = TraceProfile(input=os.fspath(input_filename), output=os.fspath(output_filename), quality=quality, workers=workers)
+        with profile.stage('load'):
+            img = Image.open(input_filename).convert('RGB')
+        with profile.stage('downscale'):
+            img = self.downscale_image(img)
+        with profile.stage('quantize'):
+            q = self.quantize(img)
         w, h = q.size
+        profile.info['size'] = [w, h]
 
-        palette = q.getpalette()
-        index_to_rgb = {}
-        for i in range(self.n_colors):
-            r, g, b = palette[3*i:3*i+3]
-            index_to_rgb[i] = (r, g, b)
-        
-        indices = list(q.getdata())
-        used_indices = sorted(set(indices))
-        svg_paths = []
-
-        for idx in used_indices:
-            if indices.count(idx) < self.min_pixels:
+        with profile.stage('write'):
+            self.write_svg(output_filename, w, h, self.trace_colors(q, workers, profile, progress))
+        return profile
+
+    def global_palette(self, img, sample_pixels=1 << 20):
+        ''' Quantize a reduced copy of the image to get one palette shared by every tile '''
+        factor = max(1, int((img.width * img.height / sample_pixels) ** 0.5))
+        sample = img.reduce(factor) if factor > 1 else img
+        return self.quantize(sample)
+
+    def iter_tiles(self, w, h, tile_size, overlap):
+        ''' Yield (core, box) rectangles, the box being the core grown by overlap pixels '''
+        for y0 in range(0, h, tile_size):
+            for x0 in range(0, w, tile_size):
+                x1, y1 = min(x0 + tile_size, w), min(y0 + tile_size, h)
+                box = (max(0, x0 - overlap), max(0, y0 - overlap), min(w, x1 + overlap), min(h, y1 + overlap))
+                yield (x0, y0, x1, y1), box
+
+    def trace_tile(self, q_tile, core, box, w, h, keep=None):
+        ''' Trace one quantized tile into a group clipped to its core rectangle, keep being the colours to trace '''
+        x0, y0, x1, y1 = core
+        bx, by = box[0], box[1]
+
+        # clip half a pixel past inner seams so antialiased edges of neighbours overlap
+        cx0 = x0 - bx - (0.5 if x0 > 0 else 0)
+        cy0 = y0 - by - (0.5 if y0 > 0 else 0)
+        cx1 = x1 - bx + (0.5 if x1 < w else 0)
+        cy1 = y1 - by + (0.5 if y1 < h else 0)
+        name = f't{x0}_{y0}'
+
+        elements = [
+            f"<clipPath id='{name}'><rect x='{self.rv(cx0)}' y='{self.rv(cy0)}' width='{self.rv(cx1 - cx0)}' height='{self.rv(cy1 - cy0)}'/></clipPath>",
+            f"<g clip-path='url(#{name})' transform='translate({bx},{by})'>",
+        ]
+        elements.extend(self.trace_colors(q_tile, keep=keep))
+        elements.append('</g>')
+        return elements
+
+    def process_tiled(self, input_filename, output_filename, quality=0.5, tile_size=1024, overlap=16, workers=1):
+        ''' Trace the image tile by tile against a shared palette, bounding tracing memory by tile size '''
+        self.configure_quality(quality)
+        max_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            img = self.load_image(input_filename)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_pixels
+
+        w, h = img.size
+        palette = self.global_palette(img)
+        tiles = list(self.iter_tiles(w, h, tile_size, overlap))
+
+        # decide which colours to keep from whole-image counts, so a region cut by a seam is traced on both sides
+        counts = np.zeros(256, dtype=np.int64)
+        for core, box in tiles:
+            counts += np.bincount(np.asarray(img.crop(core).quantize(palette=palette, dither=Image.Dither.NONE)).ravel(), minlength=256)
+        keep = frozenset(int(i) for i in np.flatnonzero(counts >= max(1, self.min_pixels)))
+
+        def quantized(core, box):
+            return img.crop(box).quantize(palette=palette, dither=Image.Dither.NONE), core, box, w, h, keep
+
+        def elements():
+            if workers <= 1:
+                for core, box in tiles:
+                    yield from self.trace_tile(*quantized(core, box))
+                return
+
+            # keep a bounded window of tiles in flight so quantized tiles never pile up
+            with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context) as pool:
+                pending = deque()
+                for core, box in tiles:
+                    pending.append(pool.submit(_trace_tile_job, (self.settings(),) + quantized(core, box)))
+                    if len(pending) >= 2 * workers:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+
+        self.write_svg(output_filename, w, h, elements())
+
+    def trace_frames(self, frames):
+        ''' Yield (size, layers) per frame, layers being (idx, paths, traced_at) in palette order.
+            The palette comes from the first frame, and a colour is only re-traced when its mask changed. '''
+        palette = None
+        prev = None
+        layers = {}
+        for n, frame in enumerate(frames):
+            img = self.downscale_image(frame.convert('RGB'))
+            if palette is None:
+                palette = self.quantize(img)
+            q = img.quantize(palette=palette, dither=Image.Dither.NONE)
+            masks = MaskEngine(q)
+
+            # colours that gained or lost a pixel since the previous frame
+            if prev is None or prev.shape != masks.indices.shape:
+                layers.clear()
+            else:
+                diff = masks.indices != prev
+                for idx in np.union1d(masks.indices[diff], prev[diff]).tolist():
+                    layers.pop(idx, None)
+            prev = masks.indices
+
+            jobs = self.color_jobs(q, masks)
+            fills = dict(jobs)
+            todo = [idx for idx, fill in jobs if idx not in layers]
+            for idx, mask in masks.iter_masks(todo):
+                layers[idx] = (list(self.iter_svg(self.trace_image(mask), fills[idx])), n)
+
+            yield q.size, [(idx,) + layers[idx] for idx, fill in jobs]
+
+    def process_frames(self, source, output, quality=0.5, animated=False, fps=10, suffix='.svg'):
+        ''' Trace a frame stream into numbered SVGs in the output directory, or one animated SVG '''
+        self.configure_quality(quality)
+        results = self.trace_frames(iter_frames(source))
+        stats = {'frames': 0, 'traced': 0, 'reused': 0}
+
+        def count(n, layers):
+            stats['frames'] += 1
+            for idx, paths, traced_at in layers:
+                stats['traced' if traced_at == n else 'reused'] += 1
+
+        if not animated:
+            os.makedirs(output, exist_ok=True)
+            for n, ((w, h), layers) in enumerate(results):
+                count(n, layers)
+                paths = (path for idx, layer, traced_at in layers for path in layer)
+                self.write_svg(os.path.join(output, f'frame_{n:05d}{suffix}'), w, h, paths)
+            return stats
+
+        first = next(results, None)
+        if first is None:
+            return stats
+        (w, h), _ = first
+
+        def elements():
+            # layers are defined once when traced and referenced by every frame that reuses them
+            frame_ids = []
+            for n, (size, layers) in enumerate(chain([first], results)):
+                count(n, layers)
+                ids = []
+                for idx, paths, traced_at in layers:
+                    layer_id = f'c{idx}f{traced_at}'
+                    if traced_at == n:
+                        yield f"<defs><g id='{layer_id}'>" + ''.join(paths) + '</g></defs>'
+                    ids.append(layer_id)
+                frame_ids.append(ids)
+
+            total = len(frame_ids)
+            for n, ids in enumerate(frame_ids):
+                uses = ''.join(f"<use href='#{layer_id}'/>" for layer_id in ids)
+                if total == 1:
+                    yield f'<g>{uses}</g>'
+                    continue
+                begin, end = n / total, (n + 1) / total
+                values, key_times = ('visible;hidden', f'0;{end:.6g}') if n == 0 else ('hidden;visible;hidden', f'0;{begin:.6g};{end:.6g}')
+                yield (f"<g visibility='{'visible' if n == 0 else 'hidden'}'><animate attributeName='visibility' values='{values}' "
+                       f"keyTimes='{key_times}' dur='{total / fps:.6g}s' calcMode='discrete' repeatCount='indefinite'/>{uses}</g>")
+
+        self.write_svg(output, w, h, elements())
+        return stats
+
+_path_token = re.compile(r'[MmLlHhVvCcZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_svg_element = re.compile(
+    r"<path d='([^']*)' fill='(?:rgb\((\d+),(\d+),(\d+)\)|#([0-9a-f]{6}))'"
+    r"|<clipPath id='([^']*)'><rect x='([-\d.]+)' y='([-\d.]+)' width='([-\d.]+)' height='([-\d.]+)'"
+    r"|<g\b([^>]*)>|</g>|<defs>")
+_group_translate = re.compile(r"translate\(([-\d.]+),([-\d.]+)\)")
+_group_clip = re.compile(r"clip-path='url\(#([^)']*)\)'")
+
+def parse_path(d):
+    ''' Parse SVG path data into subpaths of absolute ('L', p) and ('C', c1, c2, p) segments '''
+    tokens = _path_token.findall(d)
+    subpaths = []
+    segments = None
+    x = y = sx = sy = 0.0
+    cmd = None
+    i = 0
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            cmd = tokens[i]
+            i += 1
+            if cmd in 'Zz':
+                x, y = sx, sy
                 continue
+        elif cmd is None or cmd in 'Zz':
+            raise ValueError(f'path data without a command: {d[:40]}')
 
-            r, g, b = index_to_rgb[idx]
-            fill = f'rgb({r},{g},{b})'
+        rel = cmd.islower()
+        op = cmd.upper()
+        if op == 'M':
+            nx, ny = float(tokens[i]), float(tokens[i + 1])
+            x, y = (x + nx, y + ny) if rel else (nx, ny)
+            sx, sy = x, y
+            segments = []
+            subpaths.append(((x, y), segments))
+            i += 2
+            # coordinates after a moveto are implicit linetos
+            cmd = 'l' if rel else 'L'
+        elif op == 'L':
+            nx, ny = float(tokens[i]), float(tokens[i + 1])
+            x, y = (x + nx, y + ny) if rel else (nx, ny)
+            segments.append(('L', (x, y)))
+            i += 2
+        elif op == 'H':
+            nx = float(tokens[i])
+            x = x + nx if rel else nx
+            segments.append(('L', (x, y)))
+            i += 1
+        elif op == 'V':
+            ny = float(tokens[i])
+            y = y + ny if rel else ny
+            segments.append(('L', (x, y)))
+            i += 1
+        elif op == 'C':
+            vals = [float(t) for t in tokens[i:i + 6]]
+            if rel:
+                vals = [v + (x if k % 2 == 0 else y) for k, v in enumerate(vals)]
+            c1, c2, end = (vals[0], vals[1]), (vals[2], vals[3]), (vals[4], vals[5])
+            segments.append(('C', c1, c2, end))
+            x, y = end
+            i += 6
+        else:
+            raise ValueError(f'unsupported path command {cmd}')
+    return subpaths
 
-            mask = self.mask_for_index(idx, indices, w, h)
-            plist = self.trace_image(mask)
+def flatten_path(d, tolerance=0.5):
+    ''' Flatten SVG path data into polygons, splitting each curve so it deviates at most tolerance '''
+    polygons = []
+    for start, segments in parse_path(d):
+        points = [start]
+        x0, y0 = start
+        for segment in segments:
+            if segment[0] == 'L':
+                points.append(segment[1])
+                x0, y0 = segment[1]
+                continue
 
-            svg_paths.extend(self.build_svg(plist, fill))
-        
-        with open(output_filename, 'w') as file:
-            file.write(f"<svg xmlns='http://www.w3.org/2000/svg' width='{w}' height='{h}' viewBox='0 0 {w} {h}'>\n")
-            for path in svg_paths:
-                file.write(f'  {path}\n')
-            file.write('</svg>\n')
+            (x1, y1), (x2, y2), (x3, y3) = segment[1:]
+            # Wang's formula gives the subdivision count that keeps the chord error within tolerance
+            ddx = max(abs(x0 - 2 * x1 + x2), abs(x1 - 2 * x2 + x3))
+            ddy = max(abs(y0 - 2 * y1 + y2), abs(y1 - 2 * y2 + y3))
+            n = max(1, math.ceil(math.sqrt(0.75 * math.hypot(ddx, ddy) / tolerance)))
+            for k in range(1, n + 1):
+                t = k / n
+                mt = 1 - t
+                a, b, c, e = mt * mt * mt, 3 * mt * mt * t, 3 * mt * t * t, t * t * t
+                points.append((a * x0 + b * x1 + c * x2 + e * x3, a * y0 + b * y1 + c * y2 + e * y3))
+            x0, y0 = x3, y3
+        polygons.append(points)
+    return polygons
+
+def read_svg_paths(svg_filename):
+    ''' Yield (d, rgb, offset, clip) for every path written by ImageTracer, offset being the group translation and
+    clip the absolute (x0, y0, x1, y1) of the tile clip the path sits in, or None '''
+    opener = gzip.open if os.fspath(svg_filename).endswith('.svgz') else open
+    with opener(svg_filename, 'rt') as file:
+        text = file.read()
+
+    clips = {}
+    groups = [((0.0, 0.0), None)]
+    for match in _svg_element.finditer(text):
+        d, r, g, b, hex_fill, clip_id, cx, cy, cw, ch, attributes = match.groups()
+        if hex_fill is not None:
+            yield d, tuple(bytes.fromhex(hex_fill)), *groups[-1]
+        elif d is not None:
+            yield d, (int(r), int(g), int(b)), *groups[-1]
+        elif clip_id is not None:
+            clips[clip_id] = (float(cx), float(cy), float(cx) + float(cw), float(cy) + float(ch))
+        elif attributes is not None:
+            # every group is pushed, translated or not, so the closing tags stay balanced
+            (ox, oy), clip = groups[-1]
+            translate = _group_translate.search(attributes)
+            if translate:
+                ox, oy = ox + float(translate.group(1)), oy + float(translate.group(2))
+            clip_ref = _group_clip.search(attributes)
+            if clip_ref and clip_ref.group(1) in clips:
+                x0, y0, x1, y1 = clips[clip_ref.group(1)]
+                clip = (x0 + ox, y0 + oy, x1 + ox, y1 + oy)
+            groups.append(((ox, oy), clip))
+        elif match.group(0) == '</g>':
+            groups.pop()
+        else:
+            raise ValueError(f'{svg_filename} is an animated SVG, only single images can be read')
+
+def rasterize_svg(svg_filename, size, scale=1.0, background=(255, 255, 255)):
+    ''' Render an ImageTracer SVG into an RGB image by filling its flattened paths in order, ignoring clip paths '''
+    img = Image.new('RGB', size, background)
+    draw = ImageDraw.Draw(img)
+    for d, rgb, (ox, oy), clip in read_svg_paths(svg_filename):
+        for polygon in flatten_path(d, 0.25 / scale):
+            points = [((x + ox) * scale, (y + oy) * scale) for x, y in polygon]
+            if len(points) > 2:
+                draw.polygon(points, fill=rgb)
+    return img
+
+def iter_frames(source):
+    ''' Yield RGB frames from a directory or glob of images, an animated image, or a video decoded by ffmpeg '''
+    if os.path.isdir(source) or any(c in source for c in '*?['):
+        if os.path.isdir(source):
+            paths = [os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(BatchTracer.extensions)]
+        else:
+            paths = glob.glob(source)
+        for path in sorted(paths):
+            with Image.open(path) as img:
+                yield img.convert('RGB')
+        return
+
+    try:
+        img = Image.open(source)
+    except Image.UnidentifiedImageError:
+        yield from _ffmpeg_frames(source)
+        return
+    with img:
+        for frame in ImageSequence.Iterator(img):
+            yield frame.convert('RGB')
+
+def _ffmpeg_frames(source):
+    ''' Decode a video into RGB frames through an ffmpeg pipe '''
+    try:
+        probe = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-of', 'csv=p=0', source],
+            capture_output=True, text=True, check=True,
+        )
+    except FileNotFoundError:
+        raise RuntimeError('decoding video needs ffmpeg and ffprobe on the PATH') from None
+    w, h = (int(v) for v in probe.stdout.split(',')[:2])
+
+    frame_size = w * h * 3
+    proc = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', source, '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'], stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield Image.frombytes('RGB', (w, h), data)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+_worker = {}
+
+def _init_worker(shm_name, shape, settings):
+    ''' Attach a pool worker to the shared index buffer '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    tracer = ImageTracer()
+    tracer.apply_settings(settings)
+    _worker['shm'] = shm
+    _worker['indices'] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    _worker['tracer'] = tracer
+
+def _trace_job(job):
+    ''' Trace one palette colour inside a pool worker '''
+    idx, fill = job
+    tracer = _worker['tracer']
+    plist, stats = tracer.trace_counted(_worker['indices'] != idx)
+    return tracer.build_svg(plist, fill), stats, _peak_rss()
+
+def _trace_tile_job(job):
+    ''' Trace one tile inside a pool worker '''
+    settings, q_tile, core, box, w, h, keep = job
+    tracer = ImageTracer()
+    tracer.apply_settings(settings)
+    return tracer.trace_tile(q_tile, core, box, w, h, keep)
+
+
+class TraceCache:
+    ''' On-disk cache of traced outputs keyed by image content and tracing settings '''
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_filename, settings, suffix):
+        ''' Hash the image bytes together with the preset tuple and output format '''
+        digest = hashlib.sha256()
+        with open(input_filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(repr((settings, suffix)).encode())
+        return digest.hexdigest() + suffix
+
+    def get(self, key, output_filename):
+        ''' Copy a cached result to output_filename, returns False on a miss '''
+        path = os.path.join(self.cache_dir, key)
+        try:
+            shutil.copyfile(path, output_filename)
+        except FileNotFoundError:
+            return False
+        os.utime(path)
+        return True
+
+    def put(self, key, output_filename):
+        ''' Store a traced result, written under a temporary name so readers never see partial files '''
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(output_filename, tmp_path)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        ''' Remove least recently used entries until the cache fits in max_bytes '''
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+class BatchTracer:
+    ''' Trace many images over a process pool, skipping unchanged ones through a TraceCache '''
+    extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+    def __init__(self, output_dir, tracer=None, workers=None, cache=None, suffix='.svg', profile_filename=None):
+        self.output_dir = output_dir
+        self.tracer = tracer or ImageTracer()
+        self.profile_filename = profile_filename
+        self.workers = workers or os.cpu_count()
+        self.cache = cache
+        self.suffix = suffix
+
+    def expand_inputs(self, inputs):
+        ''' Resolve files, directories and glob patterns to (input, output) pairs '''
+        jobs = []
+        for pattern in inputs:
+            if os.path.isdir(pattern):
+                for root, dirs, files in os.walk(pattern):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.lower().endswith(self.extensions):
+                            path = os.path.join(root, name)
+                            jobs.append((path, os.path.relpath(path, pattern)))
+            else:
+                # mirror matches below the pattern's literal leading directories, like directory inputs
+                parts = os.path.normpath(pattern).split(os.sep)
+                literal = list(parts[:-1])
+                for i, part in enumerate(parts[:-1]):
+                    if glob.has_magic(part):
+                        literal = parts[:i]
+                        break
+                root = os.sep.join(literal) or ('/' if pattern.startswith('/') else '.')
+                for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+                    jobs.append((path, os.path.relpath(path, root)))
+
+        pairs = []
+        sources = {}
+        for path, relative in jobs:
+            output = os.path.join(self.output_dir, os.path.splitext(relative)[0] + self.suffix)
+            if output in sources:
+                raise ValueError(f'{sources[output]} and {path} would both be written to {output}')
+            sources[output] = path
+            pairs.append((path, output))
+        return pairs
+
+    def run(self, inputs):
+        ''' Trace every input and print a cache and throughput summary '''
+        pairs = self.expand_inputs(inputs)
+        cache_dir = self.cache.cache_dir if self.cache else None
+        jobs = [(path, output, self.tracer.settings(), cache_dir) for path, output in pairs]
+
+        start = time.perf_counter()
+        counts = {'hit': 0, 'miss': 0, 'error': 0}
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context) as pool:
+            for (path, output), (status, message) in zip(pairs, pool.map(_batch_job, jobs)):
+                counts[status] += 1
+                if status == 'error':
+                    print(f'failed {path}: {message}')
+                elif status == 'miss' and self.profile_filename:
+                    with open(self.profile_filename, 'a') as file:
+                        file.write(json.dumps(message) + '\n')
+        elapsed = time.perf_counter() - start
+
+        evicted = self.cache.evict() if self.cache else 0
+        rate = len(pairs) / elapsed if elapsed > 0 else 0.0
+        print(f"{len(pairs)} images in {elapsed:.2f}s ({rate:.2f} images/sec): "
+              f"{counts['hit']} cache hits, {counts['miss']} misses, {counts['error']} failed, {evicted} evicted")
+        return counts
+
+def _batch_job(job):
+    ''' Trace one image of a batch inside a pool worker, consulting the cache first '''
+    input_filename, output_filename, settings, cache_dir = job
+    try:
+        os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+        tracer = ImageTracer()
+        tracer.apply_settings(settings)
+        cache = TraceCache(cache_dir) if cache_dir else None
+        if cache:
+            suffix = os.path.splitext(output_filename)[1]
+            key = cache.key(input_filename, (tracer.quality_presets[tracer.quality], settings), suffix)
+            if cache.get(key, output_filename):
+                return 'hit', None
+
+        profile = tracer.process_image(input_filename, output_filename, quality=tracer.quality)
+        if cache:
+            cache.put(key, output_filename)
+        return 'miss', profile.to_dict()
+    except Exception as e:
+        return 'error', str(e)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trace raster images to SVG')
+    parser.add_argument('inputs', nargs='*', default=['examples/image_luning.png'], help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default=None, help='output .svg file for a single input, otherwise an output directory')
+    parser.add_argument('-q', '--quality', type=float, default=0.5, help='quality preset level')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='process pool size, defaults to cpu count')
+    parser.add_argument('--cache', default=None, help='directory for the traced result cache')
+    parser.add_argument('--cache-size', type=float, default=512, help='cache size limit in MB')
+    parser.add_argument('--svgz', action='store_true', help='write gzip compressed .svgz files')
+    parser.add_argument('--compact', action='store_true', help='write minified relative path data')
+    parser.add_argument('--tile-size', type=int, default=0, help='trace a single large image in tiles of this size')
+    parser.add_argument('--overlap', type=int, default=16, help='tile overlap in pixels')
+    parser.add_argument('--frames', action='store_true', help='trace the input as a video or frame sequence, into numbered SVGs or one animated .svg')
+    parser.add_argument('--fps', type=float, default=10, help='frame rate of animated SVG output')
+    parser.add_argument('--profile', default=None, help='append per-image stage timings to this JSON lines file')
+    parser.add_argument('--quantizer', choices=ImageTracer.quantizers, default='mediancut', help='colour quantization method')
+    parser.add_argument('--palette', default=None, help='fixed palette reused for every image, a JSON colour list or an image to derive it from')
+    args = parser.parse_args()
+
     tracer = ImageTracer()
-    tracer.process_image('examples/image_luning.png', 'examples/output.svg', quality=0.5)
+    tracer.configure_quality(args.quality)
+    tracer.compact = args.compact
+    tracer.quantizer = args.quantizer
+    if args.palette:
+        tracer.palette = tracer.load_palette(args.palette)
+
+    single = len(args.inputs) == 1 and os.path.isfile(args.inputs[0])
+    suffix = '.svgz' if args.svgz else '.svg'
+    output = args.output or ('examples/output' + suffix if single else 'traced')
+    if args.svgz and output.endswith('.svg'):
+        parser.error('--svgz conflicts with a .svg output file, name it .svgz instead')
+    if args.frames:
+        animated = output.endswith(('.svg', '.svgz'))
+        stats = tracer.process_frames(args.inputs[0], output, args.quality, animated, args.fps, suffix)
+        print(f"{stats['frames']} frames: {stats['traced']} colour layers traced, {stats['reused']} reused")
+    elif single and output.endswith(('.svg', '.svgz')):
+        if args.tile_size:
+            tracer.process_tiled(args.inputs[0], output, args.quality, args.tile_size, args.overlap, args.workers or 1)
+        else:
+            profile = tracer.process_image(args.inputs[0], output, quality=args.quality, workers=args.workers or 1)
+            if args.profile:
+                profile.write_jsonl(args.profile)
+    else:
+        cache = TraceCache(args.cache, int(args.cache_size * 1024 * 1024)) if args.cache else None
+        batch = BatchTracer(output, tracer, args.workers, cache, suffix, args.profile)
+        try:
+            batch.run(args.inputs)
+        except ValueError as e:
+            parser.error(str(e))